@@ -1,8 +1,23 @@
 from fastapi import FastAPI, HTTPException, Response
 from fastapi import Query
-from datetime import datetime
-from pydantic import BaseModel
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, field_validator
+from bisect import bisect_left, bisect_right
+from chromadb.api.async_fastapi import AsyncFastAPI
+from chromadb.config import Settings
+from chromadb.errors import NotFoundError
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from logging.handlers import QueueHandler, QueueListener
 import chromadb
+import asyncio
+import atexit
+import logging
+import queue
+import orjson
+import os
+import sqlite3
+import time
 import uuid
 
 SERVERS = [
@@ -23,37 +38,194 @@ FRAGMENTS = {
     },
 }
 
-app = FastAPI()
+SERVERS_BY_NAME = {s["name"].lower(): s for s in SERVERS}
 
 
-class DBVS1Metadata(BaseModel):
-    timestamp: str | None = None
-    final_score: float
-    study_year: int
+def _build_fragment_routes():
+    # Per server: fragments sorted by year_range, with parallel low/high bound lists for bisect
+    routes = {}
+    for server_name, frags in FRAGMENTS.items():
+        rows = sorted((f["year_range"][0], f["year_range"][1], f["database"]) for f in frags.values())
+        routes[server_name] = ([r[0] for r in rows], [r[1] for r in rows], rows)
+    return routes
+
+
+FRAGMENT_ROUTES = _build_fragment_routes()
+
+# Collections the request paths read from every fragment of each server; the ones absent at startup
+# go straight into the miss cache
+PREWARM_COLLECTIONS = {
+    "DBVS1": ("students", "support_tickets", "course_review"),
+    "DBVS2": ("students", "documents", "courses", "exams", "programs"),
+}
+
+# Flat (server, db) views of FRAGMENTS for the per-request fan-outs
+FRAGMENT_DBS = {server_name: tuple(f["database"] for f in frags.values()) for server_name, frags in FRAGMENTS.items()}
+ALL_FRAGMENT_DBS = tuple((server_name, db_name) for server_name, dbs in FRAGMENT_DBS.items() for db_name in dbs)
+
+
+def _build_peer_dbs():
+    # Each database mapped to the database holding the same fragment type on the other server
+    peers = {}
+    for frag_type, frag_info in FRAGMENTS["DBVS1"].items():
+        db1, db2 = frag_info["database"], FRAGMENTS["DBVS2"][frag_type]["database"]
+        peers[db1], peers[db2] = db2, db1
+    return peers
+
+
+PEER_DB = _build_peer_dbs()
+
+
+def _build_move_plans():
+    # Every legal DBVS2 course move mapped to the (source, target) DBVS1 review databases it implies
+    dbs = [f["database"] for f in FRAGMENTS["DBVS2"].values()]
+    return {(src, tgt): (PEER_DB[src], PEER_DB[tgt]) for src in dbs for tgt in dbs if src != tgt}
+
+
+MOVE_PLANS = _build_move_plans()
+
+# Handlers only enqueue records; formatting and stream writes happen on the listener thread
+_log_queue = queue.Queue(-1)
+_log_listener = QueueListener(_log_queue, logging.StreamHandler())
+_log_listener.start()
+atexit.register(_log_listener.stop)
+
+logger = logging.getLogger("api")
+logger.addHandler(QueueHandler(_log_queue))
+logger.setLevel(logging.INFO)
+
 
-    class Config:
-        extra = "forbid"
+class ORJSONResponse(Response):
+    # Returning an instance directly from a handler also skips FastAPI's jsonable_encoder pass
+    media_type = "application/json"
 
+    def render(self, content) -> bytes:
+        return orjson.dumps(content)
 
-class DBVS2Metadata(BaseModel):
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await prewarm_collections()
+    await warm_policy_collections()
+    try:
+        await recover_student_inserts()
+    except Exception as e:
+        logger.warning("Insert recovery skipped: %s", e)
+    keep_warm = asyncio.ensure_future(_keep_policy_collections_warm())
+    yield
+    keep_warm.cancel()
+    # AsyncFastAPI shares one httpx pool per event loop across every client; close it on shutdown
+    while AsyncFastAPI._clients:
+        _, http_client = AsyncFastAPI._clients.popitem()
+        await http_client.aclose()
+
+
+app = FastAPI(default_response_class=ORJSONResponse, lifespan=lifespan)
+
+# One AsyncHttpClient per (server, db); creating a client costs a tenant/database handshake.
+# Collection handles are cached the same way to skip the get_or_create round-trip. A handle
+# stays valid until its collection is dropped, so restart the API after re-running the loaders.
+_CLIENTS = {}
+_COLLECTIONS = {}
+_CACHE_LOCK = asyncio.Lock()
+
+# (server, db, collection) -> when get_collection last reported it missing. Negative entries expire
+# after COLLECTION_MISS_TTL so collections created by other workers are picked up.
+_MISSING_COLLECTIONS = {}
+COLLECTION_MISS_TTL = 30.0
+
+# Keep-alive pool for the httpx client behind AsyncHttpClient, so bursts reuse open connections
+HTTP_MAX_CONNECTIONS = 200
+HTTP_MAX_KEEPALIVE_CONNECTIONS = 100
+HTTP_KEEPALIVE_SECS = 60.0
+
+# Student ids come from an in-process counter seeded once from the fragments. Ids are split into
+# aligned blocks of STUDENT_ID_BLOCK; a worker claims a block by adding a "block:<n>" row carrying
+# its _ID_OWNER token to students_meta on STUDENT_ID_COUNTER. Chroma keeps the first add of an id,
+# so reading the owner back tells each worker which blocks it won. A "counter" row holds the
+# high-water mark of claimed ids so claims can start past blocks that are already taken.
+STUDENT_ID_COUNTER = ("DBVS1", "db11")
+STUDENT_ID_BLOCK = 1000
+_ID_STATE = {}
+_ID_LOCK = asyncio.Lock()
+_ID_OWNER = uuid.uuid4().hex
+
+# Bookkeeping rows (id blocks, the id counter, insert intents) are never searched. Sending this fixed
+# embedding with them stops AsyncHttpClient from running its embedding model on the event loop.
+BOOKKEEPING_EMBEDDING = [0.0]
+
+# Two-server inserts write an intent row to a students_tx collection on STUDENT_TX_LOG before
+# touching either fragment and clear it once both sides are settled. On startup, intents older than
+# STUDENT_TX_RECOVERY_AGE seconds (so not still in flight on another worker) are resolved.
+STUDENT_TX_LOG = ("DBVS1", "db11")
+STUDENT_TX_RECOVERY_AGE = 60.0
+_BACKGROUND_TASKS = set()
+
+# (server, student_id) -> db of the fragment last seen holding that student. Only a routing hint:
+# lookups verify it and fall back to querying every fragment, so entries gone stale
+# (e.g. written by another worker) cost one extra round-trip, not a wrong answer.
+STUDENT_LOCATIONS = {}
+
+# Optional SQLite file backing STUDENT_LOCATIONS, so the index survives restarts and is shared by the
+# workers on one host. Unset keeps the index in-process only. All SQLite work runs in order on one
+# executor thread, off the event loop; its errors are logged and never fail a request.
+STUDENT_LOCATIONS_DB = os.environ.get("STUDENT_LOCATIONS_DB")
+_LOCATION_STORE = {}
+_LOCATION_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="student-locations")
+
+# (start_year, end_year, format) -> (fragment row counts, response body, cached_at) of a /students call.
+# Reused while the counts match and the entry is younger than STUDENTS_CACHE_TTL; every student
+# write made by this process clears it. The TTL bounds staleness from in-place updates on other workers.
+_STUDENTS_CACHE = {}
+STUDENTS_CACHE_TTL = 30.0
+
+# Policy collections get a warm-up query on startup and again every POLICY_KEEP_WARM_SECS,
+# so idle indexes are not evicted to cold storage between ticket lookups
+POLICY_KEEP_WARM_SECS = 300.0
+
+# (target db, top_k, query field) -> [(query, future)] waiting for the next combined policy query
+_PENDING_POLICY_QUERIES = {}
+POLICY_QUERY_WAIT = 0.005
+POLICY_QUERY_MAX_BATCH = 32
+
+# Rows per collection.get when paging through a students fragment
+STUDENTS_PAGE_SIZE = 1000
+
+# Rows per collection.add when writing a batch of students
+STUDENT_ADD_CHUNK = 1000
+
+# (server, db) -> [(ids, documents, metadatas, future)] waiting for the next combined add.
+# Concurrent inserts into one fragment share a round-trip; STUDENT_ADD_WAIT is how long
+# the first writer holds the batch open.
+_PENDING_ADDS = {}
+STUDENT_ADD_WAIT = 0.002
+
+# [second, formatted] of the last timestamp handed out by utc_timestamp()
+_TIMESTAMP_CACHE = [None, None]
+
+
+class StudentMetadata(BaseModel):
+    study_year: int | None = None
     student_id: int | None = None
-    name: str
-    surname: str
-    email: str
-    study_year: int
+    name: str | None = None
+    surname: str | None = None
+    email: str | None = None
+    final_score: float | None = None
+    timestamp: str | None = None
 
-    class Config:
-        extra = "forbid"
+    @field_validator("study_year", mode="before")
+    @classmethod
+    def _study_year_or_none(cls, value):
+        # Anything int() cannot read becomes None, so _prepare_student answers 400 as before
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            return None
 
 
 class Student(BaseModel):
     document: str
-    metadata: dict
-
-
-class StudentUpdate(BaseModel):
-    document: str | None = None
-    metadata: dict
+    metadata: StudentMetadata
 
 
 class CourseReviewCreate(BaseModel):
@@ -61,199 +233,650 @@ class CourseReviewCreate(BaseModel):
 
 
 def get_server_by_name(name: str):
-    for s in SERVERS:
-        if s["name"].lower() == name.lower():
-            return s
-    raise HTTPException(status_code=400, detail=f"Server '{name}' not found.")
-
-
-def get_client(server_name: str, db_name: str):
-    server = get_server_by_name(server_name)
-    return chromadb.HttpClient(
-        tenant=TENANT,
-        database=db_name,
-        host=server["host"],
-        port=server["port"],
+    server = SERVERS_BY_NAME.get(name.lower())
+    if server is None:
+        raise HTTPException(status_code=400, detail=f"Server '{name}' not found.")
+    return server
+
+
+async def get_client(server_name: str, db_name: str):
+    key = (server_name, db_name)
+    client = _CLIENTS.get(key)
+    if client is None:
+        server = get_server_by_name(server_name)
+        async with _CACHE_LOCK:
+            client = _CLIENTS.get(key)
+            if client is None:
+                client = await chromadb.AsyncHttpClient(
+                    tenant=TENANT,
+                    database=db_name,
+                    host=server["host"],
+                    port=server["port"],
+                    # AsyncHttpClient writes host/port into the Settings it gets, so build a fresh one
+                    settings=Settings(
+                        chroma_http_max_connections=HTTP_MAX_CONNECTIONS,
+                        chroma_http_max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+                        chroma_http_keepalive_secs=HTTP_KEEPALIVE_SECS,
+                    ),
+                )
+                _CLIENTS[key] = client
+    return client
+
+
+async def get_collection_handle(server_name: str, db_name: str, collection_name: str, create: bool = True):
+    # create=False behaves like get_collection and raises if it is missing; a NotFoundError is
+    # remembered for COLLECTION_MISS_TTL seconds so absent fragments are not probed on every request
+    key = (server_name, db_name, collection_name)
+    collection = _COLLECTIONS.get(key)
+    if collection is None:
+        if not create:
+            missed_at = _MISSING_COLLECTIONS.get(key)
+            if missed_at is not None and time.monotonic() - missed_at < COLLECTION_MISS_TTL:
+                raise NotFoundError(f"Collection [{collection_name}] does not exist")
+        client = await get_client(server_name, db_name)
+        if create:
+            collection = await client.get_or_create_collection(collection_name)
+        else:
+            try:
+                collection = await client.get_collection(collection_name)
+            except NotFoundError:
+                _MISSING_COLLECTIONS[key] = time.monotonic()
+                raise
+        _MISSING_COLLECTIONS.pop(key, None)
+        _COLLECTIONS[key] = collection
+    return collection
+
+
+async def prewarm_collections():
+    # One list_collections per (server, db) returns every handle there and shows which expected ones are absent.
+    # Servers that are down are retried lazily by get_collection_handle.
+    async def _list(server_name: str, db_name: str):
+        client = await get_client(server_name, db_name)
+        return await client.list_collections()
+
+    listings = await asyncio.gather(*[_list(s, d) for s, d in ALL_FRAGMENT_DBS], return_exceptions=True)
+    now = time.monotonic()
+    for (server_name, db_name), listing in zip(ALL_FRAGMENT_DBS, listings):
+        if isinstance(listing, Exception):
+            logger.warning("Prewarm skipped %s/%s: %s", server_name, db_name, listing)
+            continue
+        names = set()
+        for collection in listing:
+            names.add(collection.name)
+            _COLLECTIONS.setdefault((server_name, db_name, collection.name), collection)
+        for collection_name in PREWARM_COLLECTIONS[server_name]:
+            if collection_name not in names:
+                _MISSING_COLLECTIONS[(server_name, db_name, collection_name)] = now
+
+
+async def warm_policy_collections():
+    # One tiny query per policy collection, so the first ticket lookup does not pay for loading
+    # the vector index on the server or the embedding model here
+    handles = [collection for key, collection in list(_COLLECTIONS.items()) if key[0] == "DBVS2" and key[2] == "documents"]
+    await asyncio.gather(
+        *[collection.query(query_texts=["warmup"], n_results=1, include=[]) for collection in handles],
+        return_exceptions=True,
     )
 
 
-def resolve_fragment(server_name: str, study_year: int):
-    fragments = FRAGMENTS[server_name]
-    for frag_type, frag_info in fragments.items():
-        if frag_info["year_range"][0] <= study_year <= frag_info["year_range"][1]:
-            return frag_info["database"]
-    raise HTTPException(
-        status_code=400,
-        detail=f"No fragment found for study_year {study_year} on {server_name}",
-    )
+async def _keep_policy_collections_warm():
+    while True:
+        await asyncio.sleep(POLICY_KEEP_WARM_SECS)
+        await warm_policy_collections()
+
+
+async def get_students_collection(server_name: str, db_name: str):
+    return await get_collection_handle(server_name, db_name, "students")
+
 
+def _compile_resolve_fragment():
+    # FRAGMENTS is fixed at import, so emit the routing table as a straight run of comparisons
+    lines = ["def resolve_fragment(server_name, study_year):"]
+    for i, (server_name, (_, _, rows)) in enumerate(FRAGMENT_ROUTES.items()):
+        lines.append(f"    {'if' if i == 0 else 'elif'} server_name == {server_name!r}:")
+        for low, high, db_name in rows:
+            lines.append(f"        if {low!r} <= study_year <= {high!r}: return {db_name!r}")
+    lines.append("    raise HTTPException(")
+    lines.append("        status_code=400,")
+    lines.append('        detail=f"No fragment found for study_year {study_year} on {server_name}",')
+    lines.append("    )")
 
-def detect_metadata_type(metadata: dict):
-    if "final_score" in metadata:
-        DBVS1Metadata(**metadata)
-        return "DBVS1"
-    elif all(k in metadata for k in ["name", "surname", "email", "study_year"]):
-        DBVS2Metadata(**metadata)
-        return "DBVS2"
+    namespace = {"HTTPException": HTTPException}
+    exec(compile("\n".join(lines), "<resolve_fragment>", "exec"), namespace)
+    return namespace["resolve_fragment"]
+
+
+resolve_fragment = _compile_resolve_fragment()
+
+
+def fragments_in_range(server_name: str, start_year: int | None = None, end_year: int | None = None):
+    lows, highs, rows = FRAGMENT_ROUTES[server_name]
+    lo = 0 if start_year is None else bisect_left(highs, start_year)
+    hi = len(rows) if end_year is None else bisect_right(lows, end_year)
+    return [db_name for _, _, db_name in rows[lo:hi]]
+
+
+def _location_store():
+    # Opened lazily on the executor thread, so every uvicorn worker gets its own connection
+    conn = _LOCATION_STORE.get("conn")
+    if conn is None:
+        conn = sqlite3.connect(STUDENT_LOCATIONS_DB, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS student_locations (server TEXT, sid TEXT, db TEXT, PRIMARY KEY (server, sid))"
+        )
+        _LOCATION_STORE["conn"] = conn
+    return conn
+
+
+async def _location_sql(work):
+    # Runs work(conn) on the executor thread; the index is only a hint, so failures just return None
+    if not STUDENT_LOCATIONS_DB:
+        return None
+    try:
+        return await asyncio.get_running_loop().run_in_executor(_LOCATION_EXECUTOR, lambda: work(_location_store()))
+    except sqlite3.Error as e:
+        logger.warning("Student location index unavailable: %s", e)
+        return None
+
+
+async def student_location(server_name: str, sid: str):
+    key = (server_name, sid)
+    db_name = STUDENT_LOCATIONS.get(key)
+    if db_name is None:
+        row = await _location_sql(
+            lambda conn: conn.execute("SELECT db FROM student_locations WHERE server = ? AND sid = ?", key).fetchone()
+        )
+        if row is not None:
+            db_name = STUDENT_LOCATIONS[key] = row[0]
+    return db_name
+
+
+async def remember_student_locations(entries, overwrite: bool = True):
+    # entries: ((server, sid), db) pairs; overwrite=False only fills in students not indexed yet
+    entries = list(entries)
+    if overwrite:
+        STUDENT_LOCATIONS.update(entries)
     else:
-        raise HTTPException(status_code=400, detail="Invalid metadata structure.")
+        for key, db_name in entries:
+            STUDENT_LOCATIONS.setdefault(key, db_name)
 
+    verb = "REPLACE" if overwrite else "IGNORE"
+    rows = [(server_name, sid, db_name) for (server_name, sid), db_name in entries]
 
+    def _write(conn):
+        with conn:
+            conn.executemany(f"INSERT OR {verb} INTO student_locations VALUES (?, ?, ?)", rows)
 
-@app.post("/student")
-def insert_student(student: Student):
-    meta_in = dict(student.metadata or {})
+    await _location_sql(_write)
 
-    if not isinstance(meta_in.get("study_year"), int):
+
+async def forget_student_location(server_name: str, sid: str):
+    STUDENT_LOCATIONS.pop((server_name, sid), None)
+
+    def _delete(conn):
+        with conn:
+            conn.execute("DELETE FROM student_locations WHERE server = ? AND sid = ?", (server_name, sid))
+
+    await _location_sql(_delete)
+
+
+def _row_by_id(data: dict, rid: str):
+    # (document, metadata, embedding) for rid from a get() result in one pass; fields left out of include come back as None
+    ids = data.get("ids") or []
+    try:
+        pos = ids.index(rid)
+    except ValueError:
+        return None
+    docs = data.get("documents")
+    metas = data.get("metadatas")
+    embeddings = data.get("embeddings")
+    return (
+        docs[pos] if docs is not None else None,
+        (metas[pos] if metas is not None else None) or {},
+        embeddings[pos] if embeddings is not None else None,
+    )
+
+
+def _course_id_where(course_id_str: str):
+    # Reviews store course_id as an int, but may carry the string form; match either server-side
+    if course_id_str.isdigit():
+        return {"$or": [{"course_id": int(course_id_str)}, {"course_id": course_id_str}]}
+    return {"course_id": course_id_str}
+
+
+async def _find_in_fragments(server_name: str, collection_name: str, rid: str, include: list):
+    # Look rid up in every fragment of the server concurrently; an id lives in one fragment,
+    # so return on the first hit and cancel the lookups still in flight. A fragment that fails to read
+    # only matters if no other fragment has the id; then the failure is raised instead of a "not found"
+    read_errors = []
+
+    async def _scan(db_name: str):
         try:
-            meta_in["study_year"] = int(meta_in.get("study_year"))
-        except (ValueError, TypeError):
-            raise HTTPException(status_code=400, detail="study_year must be an integer")
+            collection = await get_collection_handle(server_name, db_name, collection_name, create=False)
+        except Exception:
+            return None
+        try:
+            data = await collection.get(ids=[rid], include=include)
+        except Exception as e:
+            read_errors.append(e)
+            return None
+        row = _row_by_id(data, rid)
+        if row is None:
+            return None
+        hit = {"db": db_name, "collection": collection, "doc": row[0], "meta": row[1]}
+        if "embeddings" in include:
+            hit["embedding"] = row[2]
+        return hit
+
+    # Students go straight to the fragment the location index points at; a stale hint falls back to the fan-out
+    hint_key = (server_name, rid) if collection_name == "students" else None
+    hinted_db = await student_location(*hint_key) if hint_key else None
+    if hinted_db is not None:
+        hit = await _scan(hinted_db)
+        if hit is not None:
+            return hit
+        if not read_errors:
+            await forget_student_location(*hint_key)
+
+    tasks = [asyncio.ensure_future(_scan(db_name)) for db_name in FRAGMENT_DBS[server_name]]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            hit = await next_done
+            if hit is not None:
+                if hint_key:
+                    await remember_student_locations([(hint_key, hit["db"])])
+                return hit
+        if read_errors:
+            raise read_errors[0]
+        return None
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+            elif not task.cancelled():
+                task.exception()  # mark failures of lookups we no longer need as retrieved
+
+
+STUDY_YEARS = (1, 2, 3, 4)
+
+
+def utc_timestamp():
+    # Second-resolution ISO timestamp; formatted once per second, not once per call
+    sec = int(time.time())
+    if _TIMESTAMP_CACHE[0] != sec:
+        _TIMESTAMP_CACHE[:] = [sec, time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(sec))]
+    return _TIMESTAMP_CACHE[1]
+
+
+def _prepare_student(student: Student, now: str | None = None):
+    meta_in = student.metadata
 
-    study_year = meta_in.get("study_year")
-    if study_year not in [1, 2, 3, 4]:
+    # study_year is already an int, coerced by StudentMetadata; None means it was missing or unreadable
+    study_year = meta_in.study_year
+    if study_year is None:
+        raise HTTPException(status_code=400, detail="study_year must be an integer")
+    if study_year not in STUDY_YEARS:
         raise HTTPException(status_code=400, detail="study_year must be 1, 2, 3, or 4")
 
-    if "final_score" not in meta_in:
+    if meta_in.final_score is None:
         raise HTTPException(status_code=400, detail="Missing required field: final_score for DBVS1 metadata")
 
     dbvs1_meta = {
-        "final_score": meta_in.get("final_score"),
+        "final_score": meta_in.final_score,
         "study_year": study_year,
+        "timestamp": meta_in.timestamp or now or utc_timestamp(),
     }
-    if "timestamp" in meta_in:
-        dbvs1_meta["timestamp"] = meta_in["timestamp"]
-    else:
-        dbvs1_meta["timestamp"] = datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
-
-    DBVS1Metadata(**dbvs1_meta)
 
-    missing_dbvs2 = [k for k in ["name", "surname", "email"] if k not in meta_in]
+    missing_dbvs2 = [k for k in ["name", "surname", "email"] if getattr(meta_in, k) is None]
     if missing_dbvs2:
         raise HTTPException(status_code=400, detail=f"Missing required fields for DBVS2 metadata: {', '.join(missing_dbvs2)}")
 
+    # student_id is filled in once the id is allocated
+    dbvs2_meta = {
+        "student_id": None,
+        "name": meta_in.name,
+        "surname": meta_in.surname,
+        "email": meta_in.email,
+        "study_year": study_year,
+    }
+
+    return study_year, dbvs1_meta, dbvs2_meta
+
+
+#Find max student_id across all fragments
+async def _scan_next_student_id():
+    async def _scan(server_name: str, dbname: str):
+        # Read-only: a fragment without a students collection contributes nothing, so don't create it
+        tmp_collection = await get_collection_handle(server_name, dbname, "students", create=False)
+        return await tmp_collection.get(limit=None, include=[])
+
+    responses = await asyncio.gather(*[_scan(server_name, dbname) for server_name, dbname in ALL_FRAGMENT_DBS], return_exceptions=True)
+
+    # The same ids-only scan fills the student location index
+    await remember_student_locations(
+        (
+            ((server_name, rid), dbname)
+            for (server_name, dbname), data in zip(ALL_FRAGMENT_DBS, responses)
+            if not isinstance(data, Exception)
+            for rid in data.get("ids") or []
+        ),
+        overwrite=False,
+    )
+
+    # Chroma ids are strings; non-numeric ids (e.g. uuids) are skipped without raising
+    max_id = max(
+        (int(rid) for data in responses if not isinstance(data, Exception) for rid in data.get("ids") or [] if rid.isdigit()),
+        default=0,
+    )
+    return max_id + 1
+
+
+async def _stored_id_high(meta_collection):
+    data = await meta_collection.get(ids=["counter"], include=["metadatas"])
+    metas = data.get("metadatas") or []
+    return int(metas[0].get("high", 0)) if metas and isinstance(metas[0], dict) else 0
+
+
+async def _claim_student_ids(meta_collection, start: int, count: int):
+    # Claim every block covering [start, start + count); blocks already owned by this worker are kept.
+    # If another worker owns any of them, retry past the highest foreign block. Returns (first, ceiling).
+    while True:
+        blocks = range(start // STUDENT_ID_BLOCK, (start + count - 1) // STUDENT_ID_BLOCK + 1)
+        block_ids = [f"block:{block}" for block in blocks]
+        await meta_collection.add(
+            ids=block_ids,
+            documents=["student id block"] * len(block_ids),
+            embeddings=[BOOKKEEPING_EMBEDDING] * len(block_ids),
+            metadatas=[{"owner": _ID_OWNER}] * len(block_ids),
+        )
+        data = await meta_collection.get(ids=block_ids, include=["metadatas"])
+        owners = {rid: (meta or {}).get("owner") for rid, meta in zip(data.get("ids") or [], data.get("metadatas") or [])}
+        foreign = [block for block, rid in zip(blocks, block_ids) if owners.get(rid) != _ID_OWNER]
+        if not foreign:
+            return start, (blocks[-1] + 1) * STUDENT_ID_BLOCK
+        start = (max(foreign) + 1) * STUDENT_ID_BLOCK
+
+
+async def _reserve_student_ids(count: int = 1):
+    # Hand out ids from an in-process counter; only seeding and every STUDENT_ID_BLOCK ids touch Chroma.
+    # The persisted high-water mark keeps ids monotonic across restarts (ids up to it may be skipped).
+    async with _ID_LOCK:
+        counter_server, counter_db = STUDENT_ID_COUNTER
+        meta_collection = await get_collection_handle(counter_server, counter_db, "students_meta")
+
+        if "next" not in _ID_STATE:
+            _ID_STATE["next"] = max(await _scan_next_student_id(), await _stored_id_high(meta_collection))
+            _ID_STATE["ceiling"] = _ID_STATE["next"]
+
+        first = _ID_STATE["next"]
+        if first + count > _ID_STATE["ceiling"]:
+            # Re-read the mark on every extension: past our own ceiling it means another worker claimed further
+            stored = await _stored_id_high(meta_collection)
+            start = first if stored <= _ID_STATE["ceiling"] else stored
+            first, ceiling = await _claim_student_ids(meta_collection, start, count)
+            if ceiling > await _stored_id_high(meta_collection):
+                await meta_collection.upsert(
+                    ids=["counter"],
+                    documents=["student_id counter"],
+                    embeddings=[BOOKKEEPING_EMBEDDING],
+                    metadatas=[{"high": ceiling}],
+                )
+            _ID_STATE["ceiling"] = ceiling
+
+        _ID_STATE["next"] = first + count
+        return first
+
+
+async def _queue_student_add(server_name: str, db_name: str, ids: list, documents: list, metas: list):
+    # Adds to the same fragment that arrive within STUDENT_ADD_WAIT are sent as one collection.add.
+    # Resolves to the collection, or raises the error of the combined add.
+    key = (server_name, db_name)
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+    pending = _PENDING_ADDS.get(key)
+    if pending is None:
+        pending = _PENDING_ADDS[key] = []
+        loop.call_later(STUDENT_ADD_WAIT, _start_student_flush, key)
+    pending.append((ids, documents, metas, future))
+    return await future
+
+
+def _start_student_flush(key: tuple):
+    # Held in _BACKGROUND_TASKS until done, so the flush cannot be garbage-collected while writers wait on it
+    task = asyncio.ensure_future(_flush_student_adds(key))
+    _BACKGROUND_TASKS.add(task)
+    task.add_done_callback(_BACKGROUND_TASKS.discard)
+
+
+async def _flush_student_adds(key: tuple):
+    batch = _PENDING_ADDS.pop(key, [])
+    ids = [rid for entry in batch for rid in entry[0]]
+    documents = [doc for entry in batch for doc in entry[1]]
+    metas = [meta for entry in batch for meta in entry[2]]
+    try:
+        collection = await get_students_collection(*key)
+        # Bounded request bodies for large batches. Chunks sent before a failing one stay written;
+        # _add_student_halves undoes them by deleting every id of the insert on both servers.
+        for i in range(0, len(ids), STUDENT_ADD_CHUNK):
+            end = i + STUDENT_ADD_CHUNK
+            await collection.add(documents=documents[i:end], metadatas=metas[i:end], ids=ids[i:end])
+    except Exception as e:
+        # Chroma applies each add atomically, so every writer in the batch sees the failure
+        for *_, future in batch:
+            if not future.done():
+                future.set_exception(e)
+        return
+    for *_, future in batch:
+        if not future.done():
+            future.set_result(collection)
+
+
+async def _add_student_halves(db_dbvs1: str, db_dbvs2: str, ids: list, documents: list, dbvs1_metas: list, dbvs2_metas: list):
+    # Write both vertical halves concurrently; whichever side succeeded is undone if the other fails.
+    # Returns None on success, otherwise the error detail.
+    # Record the intent first, so a crash between the two writes leaves a trace for recover_student_inserts
+    txid = uuid.uuid4().hex
+    try:
+        tx_log = await get_collection_handle(*STUDENT_TX_LOG, "students_tx")
+        await tx_log.upsert(
+            ids=[txid],
+            documents=["insert"],
+            metadatas=[{"dbvs1": db_dbvs1, "dbvs2": db_dbvs2, "ids": orjson.dumps(ids).decode(), "started": time.time()}],
+            embeddings=[BOOKKEEPING_EMBEDDING],
+        )
+    except Exception as e:
+        return f"Failed to record insert intent: {str(e)}"
+
+    res1, res2 = await asyncio.gather(
+        _queue_student_add("DBVS1", db_dbvs1, ids, documents, dbvs1_metas),
+        _queue_student_add("DBVS2", db_dbvs2, ids, documents, dbvs2_metas),
+        return_exceptions=True,
+    )
+    _STUDENTS_CACHE.clear()
+
+    if not isinstance(res1, Exception) and not isinstance(res2, Exception):
+        _forget_insert_intent(tx_log, txid)
+        return None
+
+    # Undo on both servers: a failed side may still hold the chunks it wrote before the failure
+    async def _undo(server_name: str, db_name: str):
+        collection = await get_students_collection(server_name, db_name)
+        await collection.delete(ids=ids)
+
+    failures = [
+        f"Insert into {where} failed: {str(res)}"
+        for where, res in ((f"DBVS1:{db_dbvs1}", res1), (f"DBVS2:{db_dbvs2}", res2))
+        if isinstance(res, Exception)
+    ]
+    undone = await asyncio.gather(_undo("DBVS1", db_dbvs1), _undo("DBVS2", db_dbvs2), return_exceptions=True)
+    rollback_errors = [
+        f"Rollback of {server_name} also failed: {str(err)}"
+        for server_name, err in zip(("DBVS1", "DBVS2"), undone)
+        if isinstance(err, Exception)
+    ]
+    if rollback_errors:
+        # The intent stays behind, so recovery removes the half-written rows later
+        return "; ".join(failures + rollback_errors)
+    _forget_insert_intent(tx_log, txid)
+    return "; ".join(failures) + " (rolled back)"
+
+
+def _forget_insert_intent(tx_log, txid: str):
+    # Off the response path: a leftover intent is harmless, recovery keeps rows present on both servers
+    async def _delete():
+        try:
+            await tx_log.delete(ids=[txid])
+        except Exception as e:
+            logger.warning("Could not clear insert intent %s: %s", txid, e)
+
+    task = asyncio.ensure_future(_delete())
+    _BACKGROUND_TASKS.add(task)
+    task.add_done_callback(_BACKGROUND_TASKS.discard)
+
+
+async def recover_student_inserts(min_age: float | None = None):
+    # Settle inserts whose intent was never cleared: rows present on both servers are kept,
+    # rows that reached only one server are removed. Intents younger than min_age may still be in flight.
+    min_age = STUDENT_TX_RECOVERY_AGE if min_age is None else min_age
+    tx_log = await get_collection_handle(*STUDENT_TX_LOG, "students_tx")
+    data = await tx_log.get(include=["metadatas"])
+    now = time.time()
+    for txid, meta in zip(data["ids"], data["metadatas"]):
+        meta = meta or {}
+        if now - meta.get("started", 0) < min_age:
+            continue
+        ids = orjson.loads(meta["ids"])
+        dbvs1_col, dbvs2_col = await asyncio.gather(
+            get_students_collection("DBVS1", meta["dbvs1"]),
+            get_students_collection("DBVS2", meta["dbvs2"]),
+        )
+        got1, got2 = await asyncio.gather(dbvs1_col.get(ids=ids, include=[]), dbvs2_col.get(ids=ids, include=[]))
+        only1 = sorted(set(got1["ids"]) - set(got2["ids"]))
+        only2 = sorted(set(got2["ids"]) - set(got1["ids"]))
+        _STUDENTS_CACHE.clear()
+        if only1:
+            await dbvs1_col.delete(ids=only1)
+        if only2:
+            await dbvs2_col.delete(ids=only2)
+        await tx_log.delete(ids=[txid])
+        logger.warning("RECOVER insert %s: removed DBVS1 %s DBVS2 %s", txid, only1, only2)
+
+
+@app.post("/student")
+async def insert_student(student: Student):
+    study_year, dbvs1_meta, dbvs2_meta = _prepare_student(student)
+
     # Helps to add into fragments
     db_dbvs1 = resolve_fragment("DBVS1", study_year)
     db_dbvs2 = resolve_fragment("DBVS2", study_year)
 
-    #Find max student_id across all fragments
-    def _allocate_next_student_id():
-        max_id = 0
-        for server_name, frags in FRAGMENTS.items():
-            for frag_info in frags.values():
-                dbname = frag_info["database"]
-                try:
-                    tmp_client = get_client(server_name, dbname)
-                    tmp_collection = tmp_client.get_or_create_collection("students")
-                    data = tmp_collection.get(limit=None)
-                except Exception:
-                    continue
-                for rid in data.get("ids", []) or []:
-                    try:
-                        val = int(rid)
-                        if val > max_id:
-                            max_id = val
-                    except (ValueError, TypeError):
-                        continue
-        return max_id + 1
-
     try:
-        student_id_int = _allocate_next_student_id()
+        student_id_int = await _reserve_student_ids()
         student_id = str(student_id_int)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to allocate new student id: {str(e)}")
 
-    dbvs2_meta = {
-        "student_id": student_id_int,
-        "name": meta_in.get("name"),
-        "surname": meta_in.get("surname"),
-        "email": meta_in.get("email"),
-        "study_year": study_year,
-    }
-    DBVS2Metadata(**dbvs2_meta)
+    dbvs2_meta["student_id"] = student_id_int
 
-    collection_dbvs1 = None
-    # Insert into dbvs1
-    try:
-        client_dbvs1 = get_client("DBVS1", db_dbvs1)
-        collection_dbvs1 = client_dbvs1.get_or_create_collection("students")
-        collection_dbvs1.add(
-            documents=[student.document],
-            metadatas=[dbvs1_meta],
-            ids=[student_id],
-        )
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Insert into DBVS1 failed: {str(e)}")
+    failure = await _add_student_halves(
+        db_dbvs1, db_dbvs2, [student_id], [student.document], [dbvs1_meta], [dbvs2_meta]
+    )
+    if failure:
+        raise HTTPException(status_code=500, detail=failure)
+
+    await remember_student_locations([(("DBVS1", student_id), db_dbvs1), (("DBVS2", student_id), db_dbvs2)])
+    logger.info("INSERT %s year=%d -> DBVS1/%s DBVS2/%s", student_id, study_year, db_dbvs1, db_dbvs2)
+
+    return {"message": "Student inserted successfully across DBVS1 and DBVS2", "student_id": student_id_int}
+
+
+class StudentBatch(BaseModel):
+    items: list[Student]
+
+
+@app.post("/students/bulk")
+async def insert_students_bulk(batch: StudentBatch):
+    if not batch.items:
+        raise HTTPException(status_code=400, detail="items must not be empty")
+
+    prepared = []
+    now = utc_timestamp()
+    for i, student in enumerate(batch.items):
+        try:
+            prepared.append(_prepare_student(student, now))
+        except HTTPException as e:
+            raise HTTPException(status_code=e.status_code, detail=f"items[{i}]: {e.detail}")
 
-    # Insert into dbvs2
     try:
-        client_dbvs2 = get_client("DBVS2", db_dbvs2)
-        collection_dbvs2 = client_dbvs2.get_or_create_collection("students")
-        # Force error
-        # raise RuntimeError("Test")
-        collection_dbvs2.add(
-            documents=[student.document],
-            metadatas=[dbvs2_meta],
-            ids=[student_id],
-        )
+        first_id = await _reserve_student_ids(len(batch.items))
     except Exception as e:
-        try:
-            if collection_dbvs1 is not None:
-                collection_dbvs1.delete(ids=[student_id])
-        except Exception as rollback_err:
-            raise HTTPException(
-                status_code=500,
-                detail=(
-                    f"Insert into DBVS2:{db_dbvs2} failed: {str(e)}; "
-                    f"Rollback of DBVS1 also failed: {str(rollback_err)}"
-                ),
-            )
-        raise HTTPException(
-            status_code=500,
-            detail=f"Insert into DBVS2:{db_dbvs2} failed (rolled back DBVS1): {str(e)}",
+        raise HTTPException(status_code=500, detail=f"Failed to allocate new student ids: {str(e)}")
+
+    # One add per (DBVS1 fragment, DBVS2 fragment) pair instead of one per student
+    groups = {}
+    for offset, (student, (study_year, dbvs1_meta, dbvs2_meta)) in enumerate(zip(batch.items, prepared)):
+        student_id_int = first_id + offset
+        dbvs2_meta["student_id"] = student_id_int
+        key = (resolve_fragment("DBVS1", study_year), resolve_fragment("DBVS2", study_year))
+        group = groups.setdefault(key, {"ids": [], "documents": [], "dbvs1": [], "dbvs2": []})
+        group["ids"].append(str(student_id_int))
+        group["documents"].append(student.document)
+        group["dbvs1"].append(dbvs1_meta)
+        group["dbvs2"].append(dbvs2_meta)
+
+    async def _insert_group(db_dbvs1: str, db_dbvs2: str, group: dict):
+        failure = await _add_student_halves(
+            db_dbvs1, db_dbvs2, group["ids"], group["documents"], group["dbvs1"], group["dbvs2"]
         )
+        if failure:
+            return {"error": failure}
 
-    return {"message": "Student inserted successfully across DBVS1 and DBVS2", "student_id": student_id_int}
+        await remember_student_locations(
+            entry
+            for rid in group["ids"]
+            for entry in ((("DBVS1", rid), db_dbvs1), (("DBVS2", rid), db_dbvs2))
+        )
+        logger.info("INSERT %d students -> DBVS1/%s DBVS2/%s", len(group["ids"]), db_dbvs1, db_dbvs2)
+        return {"inserted": [int(rid) for rid in group["ids"]]}
+
+    keys = list(groups)
+    outcomes = await asyncio.gather(*[_insert_group(db1, db2, groups[(db1, db2)]) for db1, db2 in keys])
+
+    results = []
+    inserted = 0
+    for (db_dbvs1, db_dbvs2), outcome in zip(keys, outcomes):
+        inserted += len(outcome.get("inserted", []))
+        results.append({"DBVS1": db_dbvs1, "DBVS2": db_dbvs2, **outcome})
+
+    return {"inserted": inserted, "failed": len(batch.items) - inserted, "groups": results}
 
 
 @app.post("/course/{course_id}/review")
-def add_course_review(course_id: int, payload: CourseReviewCreate):
-    located_fragment = None
+async def add_course_review(course_id: int, payload: CourseReviewCreate):
     course_id_str = str(course_id)
-    for frag_type, frag_info in FRAGMENTS["DBVS2"].items():
-        db_name = frag_info["database"]
-        try:
-            client = get_client("DBVS2", db_name)
-            collection = client.get_collection("courses")
-        except Exception:
-            continue
-
-        try:
-            data = collection.get(ids=[course_id_str])
-            ids = data.get("ids", []) or []
-            if course_id_str in ids:
-                located_fragment = frag_type  
-                break
-        except Exception:
-            continue
+    try:
+        found = await _find_in_fragments("DBVS2", "courses", course_id_str, [])
+    except Exception:
+        found = None
 
-    if not located_fragment:
+    if found is None:
         raise HTTPException(status_code=404, detail=f"Course '{course_id}' not found in DBVS2")
 
-    target_dbvs1_db = FRAGMENTS["DBVS1"][located_fragment]["database"]
+    target_dbvs1_db = PEER_DB[found["db"]]
 
     # Prepare review payload
-    review_id = str(uuid.uuid4())
+    review_id = uuid.uuid4().hex
     review_doc = payload.text
     review_meta = {
         "course_id": course_id,
-        "timestamp": datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ"),
+        "timestamp": utc_timestamp(),
     }
 
     try:
-        client_dbvs1 = get_client("DBVS1", target_dbvs1_db)
-        col = client_dbvs1.get_or_create_collection("course_review")
-        col.add(ids=[review_id], documents=[review_doc], metadatas=[review_meta])
+        col = await get_collection_handle("DBVS1", target_dbvs1_db, "course_review")
+        await col.add(ids=[review_id], documents=[review_doc], metadatas=[review_meta])
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to insert course review into DBVS1:{target_dbvs1_db}: {e}")
 
@@ -266,7 +889,7 @@ def add_course_review(course_id: int, payload: CourseReviewCreate):
 
 
 @app.delete("/course/{course_id}")
-def delete_course(course_id: str):
+async def delete_course(course_id: str):
     source_db2 = None
     deleted_course = False
     course_id_str = str(course_id)
@@ -274,163 +897,107 @@ def delete_course(course_id: str):
     saved_doc = None
     saved_meta = {}
 
-    for frag_info in FRAGMENTS["DBVS2"].values():
-        db_name = frag_info["database"]
-        client = get_client("DBVS2", db_name)
+    found = await _find_in_fragments("DBVS2", "courses", course_id_str, ["documents", "metadatas"])
+    if found is not None:
         try:
-            collection = client.get_collection("courses")
-        except Exception:
-            continue
-
-        data = collection.get(limit=None)
-        ids = data.get("ids", [])
-        docs = data.get("documents", [])
-        metas = data.get("metadatas", [])
-        if course_id_str in ids:
-            try:
-                idx = ids.index(course_id_str)
-                saved_doc = docs[idx] if idx < len(docs) else None
-                saved_meta = metas[idx] if idx < len(metas) and isinstance(metas[idx], dict) else {}
-                collection.delete(ids=[course_id_str])
-                deleted_course = True
-                source_db2 = db_name
-                break
-            except Exception as e:
-                raise HTTPException(status_code=500, detail=f"Failed to delete course {course_id_str} from {db_name}: {str(e)}")
+            saved_doc = found["doc"]
+            saved_meta = found["meta"]
+            await found["collection"].delete(ids=[course_id_str])
+            deleted_course = True
+            source_db2 = found["db"]
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Failed to delete course {course_id_str} from {found['db']}: {str(e)}")
 
     if not deleted_course:
         raise HTTPException(status_code=404, detail=f"Course with ID '{course_id_str}' not found in DBVS2.")
 
-    if source_db2 == "db21":
-        peer_db1 = "db11"
-    elif source_db2 == "db22":
-        peer_db1 = "db12"
-    else:
+    peer_db1 = PEER_DB.get(source_db2)
+    if peer_db1 is None:
         raise HTTPException(status_code=400, detail=f"Unknown DBVS2 database '{source_db2}'.")
 
+    # Grab every handle a later branch (including the restores) may need up front
+    course_collection = found["collection"]
+    exam_collection, review_collection, legacy_review_collection = await asyncio.gather(
+        get_collection_handle("DBVS2", source_db2, "exams", create=False),
+        get_collection_handle("DBVS1", peer_db1, "course_review", create=False),
+        get_collection_handle("DBVS1", peer_db1, "course_reviews", create=False),
+        return_exceptions=True,
+    )
+    if isinstance(exam_collection, Exception):
+        exam_collection = None
+    if isinstance(review_collection, Exception):
+        review_collection = None if isinstance(legacy_review_collection, Exception) else legacy_review_collection
+
     exam_deleted = False
     saved_exam_doc = None
     saved_exam_meta = {}
-    try:
-        exam_client = get_client("DBVS2", source_db2)
-    except Exception:
-        exam_client = None
-
-    if exam_client is not None:
+    if exam_collection is not None:
         try:
-            exam_collection = exam_client.get_collection("exams")
-        except Exception:
-            exam_collection = None
-
-        if exam_collection is not None:
+            exam_data = await exam_collection.get(ids=[course_id_str], include=["documents", "metadatas"])
+            exam_row = _row_by_id(exam_data, course_id_str)
+            if exam_row is not None:
+                saved_exam_doc, saved_exam_meta, _ = exam_row
+                await exam_collection.delete(ids=[course_id_str])
+                exam_deleted = True
+        except Exception as exam_err:
+            restore_error = None
             try:
-                exam_data = exam_collection.get(ids=[course_id_str])
-                exam_ids = exam_data.get("ids", []) or []
-                if course_id_str in exam_ids:
-                    idx = exam_ids.index(course_id_str)
-                    docs = exam_data.get("documents", []) or []
-                    metas = exam_data.get("metadatas", []) or []
-                    saved_exam_doc = docs[idx] if idx < len(docs) else None
-                    saved_exam_meta = metas[idx] if idx < len(metas) and isinstance(metas[idx], dict) else {}
-                    exam_collection.delete(ids=[course_id_str])
-                    exam_deleted = True
-            except Exception as exam_err:
-                restore_error = None
-                try:
-                    restore_collection = exam_client.get_or_create_collection("courses")
-                    restore_collection.add(
-                        ids=[course_id_str],
-                        documents=[saved_doc if isinstance(saved_doc, str) else (saved_doc or "")],
-                        metadatas=[saved_meta if isinstance(saved_meta, dict) else {}],
-                    )
-                except Exception as re:
-                    restore_error = str(re)
-                if restore_error:
-                    raise HTTPException(
-                        status_code=500,
-                        detail=(
-                            f"Failed to delete related exam {course_id_str} in {source_db2}: {str(exam_err)}; "
-                            f"also failed to restore course {course_id_str} in {source_db2}: {restore_error}"
-                        ),
-                    )
+                await course_collection.add(
+                    ids=[course_id_str],
+                    documents=[saved_doc or ""],
+                    metadatas=[saved_meta or {}],
+                )
+            except Exception as re:
+                restore_error = str(re)
+            if restore_error:
                 raise HTTPException(
                     status_code=500,
                     detail=(
                         f"Failed to delete related exam {course_id_str} in {source_db2}: {str(exam_err)}; "
-                        f"course deletion rolled back in {source_db2}"
+                        f"also failed to restore course {course_id_str} in {source_db2}: {restore_error}"
                     ),
                 )
+            raise HTTPException(
+                status_code=500,
+                detail=(
+                    f"Failed to delete related exam {course_id_str} in {source_db2}: {str(exam_err)}; "
+                    f"course deletion rolled back in {source_db2}"
+                ),
+            )
 
     deleted_reviews = 0
     try:
-        client_db1 = get_client("DBVS1", peer_db1)
-        try:
-            review_collection = client_db1.get_collection("course_review")
-        except Exception:
-            try:
-                review_collection = client_db1.get_collection("course_reviews")
-            except Exception:
-                review_collection = None
-
         ids_to_delete = []
         if review_collection is not None:
-            data = review_collection.get(limit=None)
-            ids = data.get("ids", [])
-            metas = data.get("metadatas", [])
-
-            for i, rid in enumerate(ids):
-                meta = metas[i] if i < len(metas) else {}
-                course_meta_id = None
-                if isinstance(meta, dict) and "course_id" in meta:
-                    course_meta_id = meta.get("course_id")
-                if course_meta_id is None:
-                    continue
-
-                try:
-                    if str(course_meta_id) == course_id_str:
-                        ids_to_delete.append(rid)
-                except Exception:
-                    continue
+            data = await review_collection.get(where=_course_id_where(course_id_str), include=[])
+            ids_to_delete = list(data.get("ids", []))
 
         if ids_to_delete:
             # Raise error for fragment 1
             # raise RuntimeError("Test")
-            review_collection.delete(ids=ids_to_delete)
+            await review_collection.delete(ids=ids_to_delete)
             deleted_reviews = len(ids_to_delete)
-    except HTTPException:
-        raise
     except Exception as e:
         restore_course_error = None
         restore_exam_error = None
-        restore_client = None
         try:
-            restore_client = get_client("DBVS2", source_db2)
-        except Exception as re_client:
-            restore_course_error = str(re_client)
-            if exam_deleted:
-                restore_exam_error = str(re_client)
+            await course_collection.add(
+                ids=[course_id_str],
+                documents=[saved_doc or ""],
+                metadatas=[saved_meta or {}],
+            )
+        except Exception as re_course:
+            restore_course_error = str(re_course)
 
-        if restore_client is not None:
+        if exam_deleted:
             try:
-                restore_collection = restore_client.get_or_create_collection("courses")
-                restore_collection.add(
+                await exam_collection.add(
                     ids=[course_id_str],
-                    documents=[saved_doc if isinstance(saved_doc, str) else (saved_doc or "")],
-                    metadatas=[saved_meta if isinstance(saved_meta, dict) else {}],
+                    documents=[saved_exam_doc or ""],
+                    metadatas=[saved_exam_meta or {}],
                 )
-            except Exception as re_course:
-                restore_course_error = str(re_course)
-
-            if exam_deleted:
-                try:
-                    restore_exam_collection = restore_client.get_or_create_collection("exams")
-                    restore_exam_collection.add(
-                        ids=[course_id_str],
-                        documents=[saved_exam_doc if isinstance(saved_exam_doc, str) else (saved_exam_doc or "")],
-                        metadatas=[saved_exam_meta if isinstance(saved_exam_meta, dict) else {}],
-                    )
-                except Exception as re_exam:
-                    restore_exam_error = str(re_exam)
+            except Exception as re_exam:
+                restore_exam_error = str(re_exam)
 
         failure_parts = []
         if restore_course_error:
@@ -468,7 +1035,7 @@ class MoveCourseRequest(BaseModel):
 
 
 @app.post("/course/{course_id}/move")
-def move_course(course_id: str, req: MoveCourseRequest):
+async def move_course(course_id: str, req: MoveCourseRequest):
     target_db2 = req.target_db.strip().lower()
     if target_db2 not in ("db21", "db22"):
         raise HTTPException(status_code=400, detail="target_db must be 'db21' or 'db22'")
@@ -480,24 +1047,12 @@ def move_course(course_id: str, req: MoveCourseRequest):
     src_course_doc = None
     src_course_meta = None
     src_course_collection = None
-    for frag_info in FRAGMENTS["DBVS2"].values():
-        db_name = frag_info["database"]
-        client = get_client("DBVS2", db_name)
-        try:
-            col = client.get_collection("courses")
-        except Exception:
-            continue
-        data = col.get(limit=None)
-        ids = data.get("ids", [])
-        if course_id_str in ids:
-            idx = ids.index(course_id_str)
-            docs = data.get("documents", [])
-            metas = data.get("metadatas", [])
-            src_course_doc = docs[idx] if idx < len(docs) else None
-            src_course_meta = metas[idx] if idx < len(metas) else {}
-            source_db2 = db_name
-            src_course_collection = col
-            break
+    found = await _find_in_fragments("DBVS2", "courses", course_id_str, ["documents", "metadatas"])
+    if found is not None:
+        src_course_doc = found["doc"]
+        src_course_meta = found["meta"]
+        source_db2 = found["db"]
+        src_course_collection = found["collection"]
 
     if source_db2 is None:
         raise HTTPException(status_code=404, detail=f"Course {course_id_str} not found in DBVS2")
@@ -508,67 +1063,64 @@ def move_course(course_id: str, req: MoveCourseRequest):
     # Extract linked ids from course metadata
     exam_id = src_course_meta.get("exam_id")
     program_id = src_course_meta.get("program_id")
+    exam_id_str = str(exam_id) if exam_id is not None else None
+    program_id_str = str(program_id) if program_id is not None else None
 
     # Helper to get one row by id from a collection
-    def _get_row(client, collection_name, rid):
+    async def _get_row(db_name, collection_name, rid):
         try:
-            col = client.get_collection(collection_name)
+            col = await get_collection_handle("DBVS2", db_name, collection_name, create=False)
         except Exception:
             return None, None, None
-        data = col.get(limit=None)
-        ids = data.get("ids", [])
-        if str(rid) in ids:
-            idx = ids.index(str(rid))
-            docs = data.get("documents", [])
-            metas = data.get("metadatas", [])
-            return col, docs[idx] if idx < len(docs) else None, metas[idx] if idx < len(metas) else {}
+        row = _row_by_id(await col.get(ids=[rid], include=["documents", "metadatas"]), rid)
+        if row is not None:
+            return col, row[0], row[1]
         return col, None, None
 
-    # Save source items (for rollback)
-    src_client2 = get_client("DBVS2", source_db2)
-    tgt_client2 = get_client("DBVS2", target_db2)
-
-    # Exams
-    src_exam_col, src_exam_doc, src_exam_meta = (None, None, None)
-    if exam_id is not None:
-        src_exam_col, src_exam_doc, src_exam_meta = _get_row(src_client2, "exams", exam_id)
+    async def _no_row():
+        return None, None, None
 
-    # Programs
-    src_prog_col, src_prog_doc, src_prog_meta = (None, None, None)
-    if program_id is not None:
-        src_prog_col, src_prog_doc, src_prog_meta = _get_row(src_client2, "programs", program_id)
+    # Save source items (for rollback); the exam and program lookups are independent
+    (src_exam_col, src_exam_doc, src_exam_meta), (src_prog_col, src_prog_doc, src_prog_meta) = await asyncio.gather(
+        _get_row(source_db2, "exams", exam_id_str) if exam_id is not None else _no_row(),
+        _get_row(source_db2, "programs", program_id_str) if program_id is not None else _no_row(),
+    )
 
     # Perform moves in DBVS2: course -> exams -> programs
     moved = {"course": False, "exam": False, "program": False}
     try:
+        # Bind the target handles once; the rollback branches below reuse them
+        tgt_course_col, tgt_exam_col, tgt_prog_col = await asyncio.gather(
+            get_collection_handle("DBVS2", target_db2, "courses"),
+            get_collection_handle("DBVS2", target_db2, "exams"),
+            get_collection_handle("DBVS2", target_db2, "programs"),
+        )
+
         # Move course
-        tgt_course_col = tgt_client2.get_or_create_collection("courses")
         try:
-            tgt_course_col.add(ids=[course_id_str], documents=[src_course_doc or ""], metadatas=[src_course_meta or {}])
+            await tgt_course_col.add(ids=[course_id_str], documents=[src_course_doc or ""], metadatas=[src_course_meta or {}])
         except Exception:
             # id may exist; try update
-            tgt_course_col.update(ids=[course_id_str], documents=[src_course_doc or ""], metadatas=[src_course_meta or {}])
-        src_course_collection.delete(ids=[course_id_str])
+            await tgt_course_col.update(ids=[course_id_str], documents=[src_course_doc or ""], metadatas=[src_course_meta or {}])
+        await src_course_collection.delete(ids=[course_id_str])
         moved["course"] = True
 
         # Move exam
         if exam_id is not None and src_exam_col is not None and src_exam_doc is not None and src_exam_meta is not None:
-            tgt_exam_col = tgt_client2.get_or_create_collection("exams")
             try:
-                tgt_exam_col.add(ids=[str(exam_id)], documents=[src_exam_doc or ""], metadatas=[src_exam_meta or {}])
+                await tgt_exam_col.add(ids=[exam_id_str], documents=[src_exam_doc or ""], metadatas=[src_exam_meta or {}])
             except Exception:
-                tgt_exam_col.update(ids=[str(exam_id)], documents=[src_exam_doc or ""], metadatas=[src_exam_meta or {}])
-            src_exam_col.delete(ids=[str(exam_id)])
+                await tgt_exam_col.update(ids=[exam_id_str], documents=[src_exam_doc or ""], metadatas=[src_exam_meta or {}])
+            await src_exam_col.delete(ids=[exam_id_str])
             moved["exam"] = True
 
         # Move program
         if program_id is not None and src_prog_col is not None and src_prog_doc is not None and src_prog_meta is not None:
-            tgt_prog_col = tgt_client2.get_or_create_collection("programs")
             try:
-                tgt_prog_col.add(ids=[str(program_id)], documents=[src_prog_doc or ""], metadatas=[src_prog_meta or {}])
+                await tgt_prog_col.add(ids=[program_id_str], documents=[src_prog_doc or ""], metadatas=[src_prog_meta or {}])
             except Exception:
-                tgt_prog_col.update(ids=[str(program_id)], documents=[src_prog_doc or ""], metadatas=[src_prog_meta or {}])
-            src_prog_col.delete(ids=[str(program_id)])
+                await tgt_prog_col.update(ids=[program_id_str], documents=[src_prog_doc or ""], metadatas=[src_prog_meta or {}])
+            await src_prog_col.delete(ids=[program_id_str])
             moved["program"] = True
     except Exception as e:
         # Rollback within DBVS2
@@ -576,29 +1128,29 @@ def move_course(course_id: str, req: MoveCourseRequest):
             if moved.get("program"):
                 # Move program back
                 try:
-                    src_prog_col.add(ids=[str(program_id)], documents=[src_prog_doc or ""], metadatas=[src_prog_meta or {}])
+                    await src_prog_col.add(ids=[program_id_str], documents=[src_prog_doc or ""], metadatas=[src_prog_meta or {}])
                 except Exception:
-                    src_prog_col.update(ids=[str(program_id)], documents=[src_prog_doc or ""], metadatas=[src_prog_meta or {}])
+                    await src_prog_col.update(ids=[program_id_str], documents=[src_prog_doc or ""], metadatas=[src_prog_meta or {}])
                 try:
-                    tgt_client2.get_or_create_collection("programs").delete(ids=[str(program_id)])
+                    await tgt_prog_col.delete(ids=[program_id_str])
                 except Exception:
                     pass
             if moved.get("exam"):
                 try:
-                    src_exam_col.add(ids=[str(exam_id)], documents=[src_exam_doc or ""], metadatas=[src_exam_meta or {}])
+                    await src_exam_col.add(ids=[exam_id_str], documents=[src_exam_doc or ""], metadatas=[src_exam_meta or {}])
                 except Exception:
-                    src_exam_col.update(ids=[str(exam_id)], documents=[src_exam_doc or ""], metadatas=[src_exam_meta or {}])
+                    await src_exam_col.update(ids=[exam_id_str], documents=[src_exam_doc or ""], metadatas=[src_exam_meta or {}])
                 try:
-                    tgt_client2.get_or_create_collection("exams").delete(ids=[str(exam_id)])
+                    await tgt_exam_col.delete(ids=[exam_id_str])
                 except Exception:
                     pass
             if moved.get("course"):
                 try:
-                    src_course_collection.add(ids=[course_id_str], documents=[src_course_doc or ""], metadatas=[src_course_meta or {}])
+                    await src_course_collection.add(ids=[course_id_str], documents=[src_course_doc or ""], metadatas=[src_course_meta or {}])
                 except Exception:
-                    src_course_collection.update(ids=[course_id_str], documents=[src_course_doc or ""], metadatas=[src_course_meta or {}])
+                    await src_course_collection.update(ids=[course_id_str], documents=[src_course_doc or ""], metadatas=[src_course_meta or {}])
                 try:
-                    tgt_course_col.delete(ids=[course_id_str])
+                    await tgt_course_col.delete(ids=[course_id_str])
                 except Exception:
                     pass
         except Exception as rb_err:
@@ -606,71 +1158,62 @@ def move_course(course_id: str, req: MoveCourseRequest):
         raise HTTPException(status_code=500, detail=f"Failed moving course within DBVS2: {str(e)}")
 
     # Now move course_reviews across DBVS1
-    src_db1 = "db11" if source_db2 == "db21" else "db12"
-    tgt_db1 = "db11" if target_db2 == "db21" else "db12"
+    src_db1, tgt_db1 = MOVE_PLANS[(source_db2, target_db2)]
     moved_review_ids = []
     try:
-        src_client1 = get_client("DBVS1", src_db1)
-        tgt_client1 = get_client("DBVS1", tgt_db1)
         try:
-            src_rev_col = src_client1.get_collection("course_review")
+            src_rev_col = await get_collection_handle("DBVS1", src_db1, "course_review", create=False)
         except Exception:
             src_rev_col = None
         if src_rev_col is not None:
-            data = src_rev_col.get(limit=None)
-            ids = data.get("ids", [])
-            docs = data.get("documents", [])
-            metas = data.get("metadatas", [])
-            tgt_rev_col = tgt_client1.get_or_create_collection("course_review")
-            # Move matching by metadata.course_id == course_id
-            for i, rid in enumerate(ids):
-                meta = metas[i] if i < len(metas) else {}
-                if isinstance(meta, dict) and str(meta.get("course_id")) == course_id_str:
-                    doc = docs[i] if i < len(docs) else None
-                    try:
-                        tgt_rev_col.add(ids=[rid], documents=[doc or ""], metadatas=[meta or {}])
-                    except Exception:
-                        tgt_rev_col.update(ids=[rid], documents=[doc or ""], metadatas=[meta or {}])
-                    moved_review_ids.append(rid)
-            # After adds/updates, delete from source
-            if moved_review_ids:
-                src_rev_col.delete(ids=moved_review_ids)
+            data = await src_rev_col.get(where=_course_id_where(course_id_str), include=["documents", "metadatas"])
+            tgt_rev_col = await get_collection_handle("DBVS1", tgt_db1, "course_review")
+            # Copy every review matching metadata.course_id == course_id in one upsert;
+            # the where filter guarantees each row carries a metadata dict
+            rev_ids = data.get("ids", [])
+            if rev_ids:
+                rev_docs = [doc or "" for doc in data.get("documents", [])]
+                rev_metas = data.get("metadatas", [])
+                moved_review_ids = rev_ids
+                await tgt_rev_col.upsert(ids=rev_ids, documents=rev_docs, metadatas=rev_metas)
+                # Delete exactly the snapshot that was copied, not whatever matches the filter now
+                await src_rev_col.delete(ids=rev_ids)
     except Exception as e:
         # Rollback entire DBVS2 move if review move fails
         try:
             # Move program back
             if program_id is not None and src_prog_col is not None and src_prog_doc is not None and src_prog_meta is not None:
                 try:
-                    src_prog_col.add(ids=[str(program_id)], documents=[src_prog_doc or ""], metadatas=[src_prog_meta or {}])
+                    await src_prog_col.add(ids=[program_id_str], documents=[src_prog_doc or ""], metadatas=[src_prog_meta or {}])
                 except Exception:
-                    src_prog_col.update(ids=[str(program_id)], documents=[src_prog_doc or ""], metadatas=[src_prog_meta or {}])
+                    await src_prog_col.update(ids=[program_id_str], documents=[src_prog_doc or ""], metadatas=[src_prog_meta or {}])
                 try:
-                    tgt_client2.get_or_create_collection("programs").delete(ids=[str(program_id)])
+                    await tgt_prog_col.delete(ids=[program_id_str])
                 except Exception:
                     pass
             # Move exam back
             if exam_id is not None and src_exam_col is not None and src_exam_doc is not None and src_exam_meta is not None:
                 try:
-                    src_exam_col.add(ids=[str(exam_id)], documents=[src_exam_doc or ""], metadatas=[src_exam_meta or {}])
+                    await src_exam_col.add(ids=[exam_id_str], documents=[src_exam_doc or ""], metadatas=[src_exam_meta or {}])
                 except Exception:
-                    src_exam_col.update(ids=[str(exam_id)], documents=[src_exam_doc or ""], metadatas=[src_exam_meta or {}])
+                    await src_exam_col.update(ids=[exam_id_str], documents=[src_exam_doc or ""], metadatas=[src_exam_meta or {}])
                 try:
-                    tgt_client2.get_or_create_collection("exams").delete(ids=[str(exam_id)])
+                    await tgt_exam_col.delete(ids=[exam_id_str])
                 except Exception:
                     pass
             # Move course back
             try:
-                src_course_collection.add(ids=[course_id_str], documents=[src_course_doc or ""], metadatas=[src_course_meta or {}])
+                await src_course_collection.add(ids=[course_id_str], documents=[src_course_doc or ""], metadatas=[src_course_meta or {}])
             except Exception:
-                src_course_collection.update(ids=[course_id_str], documents=[src_course_doc or ""], metadatas=[src_course_meta or {}])
+                await src_course_collection.update(ids=[course_id_str], documents=[src_course_doc or ""], metadatas=[src_course_meta or {}])
             try:
-                tgt_client2.get_or_create_collection("courses").delete(ids=[course_id_str])
+                await tgt_course_col.delete(ids=[course_id_str])
             except Exception:
                 pass
             # Cleanup any partially added reviews in target
             if moved_review_ids:
                 try:
-                    tgt_client1.get_or_create_collection("course_review").delete(ids=moved_review_ids)
+                    await tgt_rev_col.delete(ids=moved_review_ids)
                 except Exception:
                     pass
         except Exception as rb_err:
@@ -689,23 +1232,14 @@ def move_course(course_id: str, req: MoveCourseRequest):
 
 
 @app.post("/course/{course_id}/upgrade")
-def upgrade_course(course_id: str):
+async def upgrade_course(course_id: str):
     course_id_str = str(course_id)
 
-    def _locate_course_db():
-        for frag_info in FRAGMENTS["DBVS2"].values():
-            db_name = frag_info["database"]
-            client = get_client("DBVS2", db_name)
-            try:
-                col = client.get_collection("courses")
-            except Exception:
-                continue
-            data = col.get(limit=None)
-            if course_id_str in (data.get("ids", []) or []):
-                return db_name
-        return None
+    async def _locate_course_db():
+        found = await _find_in_fragments("DBVS2", "courses", course_id_str, [])
+        return found["db"] if found else None
 
-    current_db2 = _locate_course_db()
+    current_db2 = await _locate_course_db()
 
     if current_db2 is None:
         raise HTTPException(status_code=404, detail=f"Course {course_id_str} not found in DBVS2")
@@ -713,13 +1247,13 @@ def upgrade_course(course_id: str):
     if current_db2 == "db22":
         return {"message": "Course already at upper level (db22)", "course_id": course_id_str, "db": current_db2}
 
-    def _handle_upgrade_failure(failure_detail: str):
+    async def _handle_upgrade_failure(failure_detail: str):
         rollback_error = None
         try:
-            new_location = _locate_course_db()
+            new_location = await _locate_course_db()
             if new_location is not None and new_location != current_db2:
                 try:
-                    move_course(course_id, MoveCourseRequest(target_db=current_db2))
+                    await move_course(course_id, MoveCourseRequest(target_db=current_db2))
                 except HTTPException as rollback_exc:
                     rollback_error = (
                         rollback_exc.detail
@@ -741,16 +1275,16 @@ def upgrade_course(course_id: str):
     try:
         # Fail transaction
         # raise RuntimeError("Test")
-        result = move_course(course_id, MoveCourseRequest(target_db="db22"))
+        result = await move_course(course_id, MoveCourseRequest(target_db="db22"))
     except HTTPException as exc:
         failure_detail = (
             exc.detail if isinstance(exc.detail, str) else str(exc.detail)
         )
-        _handle_upgrade_failure(failure_detail)
+        await _handle_upgrade_failure(failure_detail)
         raise exc
     except Exception as exc:
         failure_detail = str(exc)
-        _handle_upgrade_failure(failure_detail)
+        await _handle_upgrade_failure(failure_detail)
         raise HTTPException(status_code=500, detail=failure_detail)
 
     result["message"] = "Course upgraded to db22"
@@ -759,129 +1293,133 @@ def upgrade_course(course_id: str):
 
 
 @app.delete("/student/{student_id}")
-def delete_student(student_id: int):
+async def delete_student(student_id: int):
     sid = str(student_id)
 
-    def locate_student(server_name: str):
-        for frag_type, frag_info in FRAGMENTS[server_name].items():
-            db_name = frag_info["database"]
-            client = get_client(server_name, db_name)
-            try:
-                collection = client.get_collection("students")
-            except Exception:
-                continue
-
-            data = collection.get(limit=None)
-            ids = data.get("ids", [])
-            docs = data.get("documents", [])
-            metas = data.get("metadatas", [])
-
-            if sid in ids:
-                idx = ids.index(sid)
-                doc = docs[idx]
-                meta = metas[idx] if idx < len(metas) and isinstance(metas[idx], dict) else {}
-                return {"db": db_name, "doc": doc, "meta": meta}
-        return None
+    async def locate_student(server_name: str):
+        return await _find_in_fragments(server_name, "students", sid, ["documents", "metadatas"])
 
     # Require presence in both vertical fragments to ensure sync
-    s1 = locate_student("DBVS1")
-    s2 = locate_student("DBVS2")
+    s1, s2 = await asyncio.gather(locate_student("DBVS1"), locate_student("DBVS2"))
 
     if not s1 or not s2:
         raise HTTPException(status_code=404, detail=f"Student '{sid}' not found in all vertical fragments")
 
     # Delete in DBVS1 then DBVS2; rollback DBVS1 if DBVS2 fails
+    _STUDENTS_CACHE.clear()
     try:
-        c1 = get_client("DBVS1", s1["db"])\
-            .get_or_create_collection("students")
-        c1.delete(ids=[sid])
+        c1 = await get_students_collection("DBVS1", s1["db"])
+        await c1.delete(ids=[sid])
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to delete from DBVS1:{s1['db']}: {e}")
 
     try:
-        c2 = get_client("DBVS2", s2["db"])\
-            .get_or_create_collection("students")
-        c2.delete(ids=[sid])
+        c2 = await get_students_collection("DBVS2", s2["db"])
+        await c2.delete(ids=[sid])
     except Exception as e:
         # Rollback DBVS1 deletion
         try:
-            c1.add(ids=[sid], documents=[s1["doc"]], metadatas=[s1["meta"]])
+            await c1.add(ids=[sid], documents=[s1["doc"]], metadatas=[s1["meta"]])
         except Exception:
             pass
         raise HTTPException(status_code=500, detail=f"Failed to delete from DBVS2:{s2['db']}: {e}")
 
+    await asyncio.gather(forget_student_location("DBVS1", sid), forget_student_location("DBVS2", sid))
     return {"message": "Student deleted successfully", "student_id": sid}
 
 
 
+def _policy_hits(query_result: dict, i: int):
+    # Results for the i-th query text/embedding of a collection.query call
+    return [
+        {"id": rid, "document": doc, "metadata": meta, "distance": distance}
+        for rid, doc, meta, distance in zip(
+            query_result["ids"][i],
+            query_result["documents"][i],
+            query_result["metadatas"][i],
+            query_result["distances"][i],
+        )
+    ]
+
+
+async def _queue_policy_query(target_db: str, top_k: int, query_field: str, query):
+    # Concurrent single-ticket lookups against one policy collection share a collection.query call.
+    # A batch is sent after POLICY_QUERY_WAIT or once it holds POLICY_QUERY_MAX_BATCH queries.
+    key = (target_db, top_k, query_field)
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+    pending = _PENDING_POLICY_QUERIES.get(key)
+    if pending is None:
+        pending = _PENDING_POLICY_QUERIES[key] = []
+        loop.call_later(POLICY_QUERY_WAIT, _send_policy_queries, key, pending)
+    pending.append((query, future))
+    if len(pending) >= POLICY_QUERY_MAX_BATCH:
+        _send_policy_queries(key, pending)
+    return await future
+
+
+def _send_policy_queries(key: tuple, batch: list):
+    # Whichever of the timer and the size limit fires second finds the batch already sent
+    if _PENDING_POLICY_QUERIES.get(key) is not batch:
+        return
+    del _PENDING_POLICY_QUERIES[key]
+
+    async def _run():
+        target_db, top_k, query_field = key
+        try:
+            collection = await get_collection_handle("DBVS2", target_db, "documents", create=False)
+            query_result = await collection.query(
+                **{query_field: [query for query, _ in batch]},
+                n_results=top_k,
+                include=["documents", "metadatas", "distances"],
+            )
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for i, (_, future) in enumerate(batch):
+            if not future.done():
+                future.set_result(_policy_hits(query_result, i))
+
+    task = asyncio.ensure_future(_run())
+    _BACKGROUND_TASKS.add(task)
+    task.add_done_callback(_BACKGROUND_TASKS.discard)
+
+
 @app.get("/support_ticket/{ticket_id}")
-def find_related_document_to_policy(
+async def find_related_document_to_policy(
     ticket_id: str,
     top_k: int = Query(5, description="Number of closest policy documents to return")
 ):
     source_server = "DBVS1"
-    source_db = None
-    source_doc = None
-    found = False
-
-    for frag_type, frag_info in FRAGMENTS[source_server].items():
-        db_name = frag_info["database"]
-        client = get_client(source_server, db_name)
-
-        try:
-            collection = client.get_collection("support_tickets")
-        except Exception:
-            continue
+    ticket = await _find_in_fragments(source_server, "support_tickets", ticket_id, ["documents", "embeddings"])
 
-        data = collection.get(limit=None)
-        ids = data.get("ids", [])
-        docs = data.get("documents", [])
-
-        if ticket_id in ids:
-            idx = ids.index(ticket_id)
-            source_doc = docs[idx]
-            source_db = db_name
-            found = True
-            break
-
-    if not found:
+    if ticket is None:
         raise HTTPException(status_code=404, detail=f"Ticket '{ticket_id}' not found in DBVS1.")
+    source_db = ticket["db"]
+    source_doc = ticket["doc"]
+    source_embedding = ticket.get("embedding")
 
     target_server = "DBVS2"
-    if source_db == "db11":
-        target_db = "db21"
-    elif source_db == "db12":
-        target_db = "db22"
-    else:
+    target_db = PEER_DB.get(source_db)
+    if target_db is None:
         raise HTTPException(status_code=400, detail=f"Invalid mapping for source DB '{source_db}'.")
 
     try:
-        target_client = get_client(target_server, target_db)
         try:
-            target_collection = target_client.get_collection("documents")
+            await get_collection_handle(target_server, target_db, "documents", create=False)
         except Exception:
             raise HTTPException(status_code=404, detail=f"'documents' collection not found in {target_db}.")
 
         # Fail transaction
         # raise RuntimeError("Test")
-        query_result = target_collection.query(
-            query_texts=[source_doc],
-            n_results=top_k
-        )
-
-        docs_found = query_result.get("documents", [[]])[0]
-        metas_found = query_result.get("metadatas", [[]])[0]
-        ids_found = query_result.get("ids", [[]])[0]
-        distances = query_result.get("distances", [[]])[0]
-
-        documents = []
-        for i in range(len(docs_found)):
-            documents.append({
-                "id": ids_found[i],
-                "document": docs_found[i],
-                "metadata": metas_found[i],
-                "distance": distances[i]
-            })
+        # Both collections use the default embedding function, so the ticket's stored vector
+        # can be queried with directly instead of embedding its text again
+        if source_embedding is not None:
+            documents = await _queue_policy_query(target_db, top_k, "query_embeddings", source_embedding)
+        else:
+            documents = await _queue_policy_query(target_db, top_k, "query_texts", source_doc)
 
         return {
             "documents": documents
@@ -893,121 +1431,295 @@ def find_related_document_to_policy(
         raise HTTPException(status_code=500, detail=f"Vector similarity query failed: {str(e)}")
 
 
+class SupportTicketBatch(BaseModel):
+    ticket_ids: list[str]
+    top_k: int = 5
 
-@app.get("/students")
-def get_all_students():
-    aggregated = {"DBVS1": {}, "DBVS2": {}}
 
-    for server_name, frags in FRAGMENTS.items():
-        for frag_type, frag_info in frags.items():
-            db_name = frag_info["database"]
-            try:
-                client = get_client(server_name, db_name)
-                try:
-                    collection = client.get_collection("students")
-                except Exception:
-                    continue
+@app.post("/support_tickets/batch")
+async def find_related_documents_to_policies(batch: SupportTicketBatch):
+    ticket_ids = list(dict.fromkeys(batch.ticket_ids))
+    if not ticket_ids:
+        # Chroma rejects a get with an empty id list
+        return {"results": {}, "missing": []}
 
-                data = collection.get(limit=None)
-                ids = data.get("ids", [])
-                docs = data.get("documents", [])
-                metas = data.get("metadatas", [])
+    async def _fetch(db_name: str):
+        try:
+            collection = await get_collection_handle("DBVS1", db_name, "support_tickets", create=False)
+        except Exception:
+            return db_name, None
+        try:
+            return db_name, await collection.get(ids=ticket_ids, include=["documents", "embeddings"])
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Failed to read support tickets from {db_name}: {str(e)}")
 
-                for i, row_id in enumerate(ids):
-                    meta = metas[i] if i < len(metas) else {}
-                    doc = docs[i] if i < len(docs) else None
+    # One get per DBVS1 fragment for the whole batch; each ticket lives in exactly one of them
+    fetched = await asyncio.gather(*[_fetch(db_name) for db_name in FRAGMENT_DBS["DBVS1"]])
+
+    async def _query(source_db: str, tickets: dict):
+        target_db = PEER_DB.get(source_db)
+        if target_db is None:
+            raise HTTPException(status_code=400, detail=f"Invalid mapping for source DB '{source_db}'.")
+        try:
+            target_collection = await get_collection_handle("DBVS2", target_db, "documents", create=False)
+        except Exception:
+            raise HTTPException(status_code=404, detail=f"'documents' collection not found in {target_db}.")
 
-                    merge_id = row_id
+        # All tickets from this fragment go to the same policy collection in a single query
+        if tickets["embeddings"] is not None:
+            query_input = {"query_embeddings": list(tickets["embeddings"])}
+        else:
+            query_input = {"query_texts": tickets["documents"]}
+        query_result = await target_collection.query(
+            **query_input,
+            n_results=batch.top_k,
+            include=["documents", "metadatas", "distances"],
+        )
+        return {rid: _policy_hits(query_result, i) for i, rid in enumerate(tickets["ids"])}
 
-                    if not merge_id:
+    try:
+        answers = await asyncio.gather(
+            *[_query(db_name, tickets) for db_name, tickets in fetched if tickets is not None and tickets["ids"]]
+        )
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Vector similarity query failed: {str(e)}")
+
+    results = {}
+    for answer in answers:
+        results.update(answer)
+
+    return {
+        "results": results,
+        "missing": [tid for tid in ticket_ids if tid not in results],
+    }
+
+
+
+def _year_range_where(start_year: int | None, end_year: int | None):
+    # Filter on study_year server-side instead of pulling every row and checking it here.
+    # The loaded CSVs store study_year as a string ("2"), API writes store an int; match either.
+    if start_year is None and end_year is None:
+        return None
+    year_filters = []
+    if start_year is not None:
+        year_filters.append({"study_year": {"$gte": start_year}})
+    if end_year is not None:
+        year_filters.append({"study_year": {"$lte": end_year}})
+    numeric = {"$and": year_filters} if len(year_filters) > 1 else year_filters[0]
+    as_strings = [
+        str(year)
+        for year in STUDY_YEARS
+        if (start_year is None or year >= start_year) and (end_year is None or year <= end_year)
+    ]
+    if not as_strings:
+        return numeric
+    return {"$or": [numeric, {"study_year": {"$in": as_strings}}]}
+
+
+def _student_fragment_targets(start_year: int | None, end_year: int | None):
+    # Fragments are pruned by their routed year_range only. A fragment whose rows all fall outside
+    # the range costs one empty where-filtered page, which is as cheap as any cached bound would be
+    # and never goes stale when other workers write.
+    return [
+        (server_name, db_name)
+        for server_name in FRAGMENT_DBS
+        for db_name in fragments_in_range(server_name, start_year, end_year)
+    ]
+
+
+_STUDENT_FIELDS = ("student_id", "name", "surname", "email", "final_score", "timestamp", "study_year")
+
+
+def _merge_metadata(mid: str, dbvs1_entry: dict, dbvs2_entry: dict):
+    # DBVS1 wins where both halves carry a field
+    dbvs1_meta = dbvs1_entry.get("metadata") or {}
+    dbvs2_meta = dbvs2_entry.get("metadata") or {}
+    fields = {k: dbvs1_meta[k] if k in dbvs1_meta else dbvs2_meta.get(k) for k in _STUDENT_FIELDS}
+
+    if fields["student_id"] is None:
+        fields["student_id"] = mid
+
+    return fields
+
+
+def _merge_student(mid: str, dbvs1_entry: dict, dbvs2_entry: dict):
+    # Collect documents from both vertical fragments
+    return {
+        "id": mid,
+        "review": dbvs1_entry.get("document"),
+        "motivational_letter": dbvs2_entry.get("document"),
+        "metadata": _merge_metadata(mid, dbvs1_entry, dbvs2_entry),
+    }
+
+
+async def _get_pages(collection, where, include):
+    offset = 0
+    while True:
+        data = await collection.get(where=where, limit=STUDENTS_PAGE_SIZE, offset=offset, include=include)
+        ids = data.get("ids") or []
+        if ids:
+            yield data
+        if len(ids) < STUDENTS_PAGE_SIZE:
+            return
+        offset += STUDENTS_PAGE_SIZE
+
+
+async def _open_student_fragments(targets: list):
+    # Fragments that cannot be opened or counted are left out, so the response never starts on a
+    # broken one. Returns the DBVS1 and DBVS2 collections, their counts, and whether any were dropped.
+    async def _open(server_name: str, db_name: str):
+        collection = await get_collection_handle(server_name, db_name, "students", create=False)
+        return collection, await collection.count()
+
+    opened = await asyncio.gather(*[_open(s, d) for s, d in targets], return_exceptions=True)
+    dbvs1_collections, dbvs2_collections, counts = [], [], []
+    dropped = False
+    for (server_name, db_name), result in zip(targets, opened):
+        if isinstance(result, Exception):
+            if not isinstance(result, NotFoundError):
+                logger.warning("Skipping students in %s:%s: %s", server_name, db_name, result)
+                dropped = True
+            continue
+        collection, count = result
+        (dbvs1_collections if server_name == "DBVS1" else dbvs2_collections).append(collection)
+        counts.append(count)
+    return dbvs1_collections, dbvs2_collections, counts, dropped
+
+
+async def _merged_students(dbvs1_collections: list, dbvs2_collections: list, where, limit: int | None = None, failed: list | None = None):
+    # Yields (id, DBVS1 half, DBVS2 half). Peak memory is one page per fragment plus the set of ids
+    # already sent. A fragment that fails mid-way is skipped from that point and noted in failed.
+    failed = [] if failed is None else failed
+    seen = set()
+
+    # DBVS1 pages drive the merge; their DBVS2 halves are fetched by id
+    for collection in dbvs1_collections:
+        try:
+            async for page in _get_pages(collection, where, ["documents", "metadatas"]):
+                page_ids = page["ids"]
+                partners = await asyncio.gather(
+                    *[
+                        c.get(ids=page_ids, where=where, include=["documents", "metadatas"])
+                        for c in dbvs2_collections
+                    ],
+                    return_exceptions=True,
+                )
+                dbvs2_rows = {}
+                for c, data in zip(dbvs2_collections, partners):
+                    if isinstance(data, Exception):
+                        logger.warning("Skipping DBVS2 halves from %s: %s", c.name, data)
+                        failed.append(c)
                         continue
+                    for rid, doc, meta in zip(data["ids"], data["documents"], data["metadatas"]):
+                        dbvs2_rows.setdefault(rid, {"document": doc, "metadata": meta or {}})
 
-                    if merge_id not in aggregated[server_name]:
-                        aggregated[server_name][merge_id] = {
-                            "document": doc,
-                            "metadata": meta if isinstance(meta, dict) else {},
-                        }
-            except HTTPException:
-                raise
-            except Exception:
-                continue
-
-    all_merge_ids = set(aggregated["DBVS1"].keys()) | set(aggregated["DBVS2"].keys())
-    students = []
-    for mid in all_merge_ids:
-        dbvs1_entry = aggregated["DBVS1"].get(mid, {})
-        dbvs2_entry = aggregated["DBVS2"].get(mid, {})
-
-        # Collect documents from both vertical fragments
-        external_document = dbvs1_entry.get("document")
-        internal_document = dbvs2_entry.get("document") 
-
-        merged = {}
-        if isinstance(dbvs2_entry.get("metadata"), dict):
-            merged.update(dbvs2_entry.get("metadata") or {})
-        if isinstance(dbvs1_entry.get("metadata"), dict):
-            merged.update(dbvs1_entry.get("metadata") or {})
-
-        fields = {
-            "student_id": None,
-            "name": None,
-            "surname": None,
-            "email": None,
-            "final_score": None,
-            "timestamp": None,
-            "study_year": None,
-        }
+                for rid, doc, meta in zip(page_ids, page["documents"], page["metadatas"]):
+                    if not rid or rid in seen:
+                        continue
+                    seen.add(rid)
+                    yield rid, {"document": doc, "metadata": meta or {}}, dbvs2_rows.get(rid, {})
+                    if limit is not None and len(seen) >= limit:
+                        return
+        except Exception as e:
+            logger.warning("Skipping the rest of DBVS1 students in %s: %s", collection.name, e)
+            failed.append(collection)
+
+    # Students that only exist in DBVS2
+    for collection in dbvs2_collections:
+        try:
+            async for page in _get_pages(collection, where, []):
+                missing = [rid for rid in page["ids"] if rid and rid not in seen]
+                if not missing:
+                    continue
+                data = await collection.get(ids=missing, include=["documents", "metadatas"])
+                for rid, doc, meta in zip(data["ids"], data["documents"], data["metadatas"]):
+                    seen.add(rid)
+                    yield rid, {}, {"document": doc, "metadata": meta or {}}
+                    if limit is not None and len(seen) >= limit:
+                        return
+        except Exception as e:
+            logger.warning("Skipping the rest of DBVS2 students in %s: %s", collection.name, e)
+            failed.append(collection)
 
-        for k in list(fields.keys()):
-            if k in merged:
-                fields[k] = merged.get(k)
 
-        if fields["student_id"] is None:
-            fields["student_id"] = mid
+@app.get("/students")
+async def get_all_students(
+    start_year: int | None = Query(None, description="Only return students with study_year >= start_year"),
+    end_year: int | None = Query(None, description="Only return students with study_year <= end_year"),
+    layout: str = Query("rows", alias="format", pattern="^(rows|columns)$", description="rows or columns"),
+):
+    where = _year_range_where(start_year, end_year)
+    targets = _student_fragment_targets(start_year, end_year)
+    dbvs1_collections, dbvs2_collections, counts, dropped = await _open_student_fragments(targets)
+
+    # Row counts are a cheap fingerprint of the fragments; reuse the last body while they hold.
+    # Bodies missing a fragment are never cached.
+    cache_key = (start_year, end_year, layout)
+    cached = _STUDENTS_CACHE.get(cache_key)
+    if not dropped and cached is not None and cached[0] == counts and time.monotonic() - cached[2] < STUDENTS_CACHE_TTL:
+        return Response(cached[1], media_type="application/json")
+    loaded_at = time.monotonic()
+
+    failed = []
+    students = _merged_students(dbvs1_collections, dbvs2_collections, where, failed=failed)
+
+    if layout == "columns":
+        # One list per field instead of one dict per student
+        ids, reviews, letters, metadatas = [], [], [], []
+        async for rid, dbvs1_entry, dbvs2_entry in students:
+            ids.append(rid)
+            reviews.append(dbvs1_entry.get("document"))
+            letters.append(dbvs2_entry.get("document"))
+            metadatas.append(_merge_metadata(rid, dbvs1_entry, dbvs2_entry))
+        columns = {"ids": ids, "reviews": reviews, "motivational_letters": letters, "metadatas": metadatas}
+        body = orjson.dumps({"count": len(ids), "columns": columns})
+        if not dropped and not failed:
+            _STUDENTS_CACHE[cache_key] = (counts, body, loaded_at)
+        return Response(body, media_type="application/json")
+
+    # Same {"students": [...]} body, written out one student at a time
+    async def _body():
+        parts = [b'{"students":[']
+        yield parts[0]
+        async for entry in students:
+            parts.append((b"," if len(parts) > 1 else b"") + orjson.dumps(_merge_student(*entry)))
+            yield parts[-1]
+        parts.append(b"]}")
+        yield parts[-1]
+        if not dropped and not failed:
+            _STUDENTS_CACHE[cache_key] = (counts, b"".join(parts), loaded_at)
+
+    return StreamingResponse(_body(), media_type="application/json")
+
+
+@app.get("/students/stream")
+async def stream_students(
+    start_year: int | None = Query(None, description="Only return students with study_year >= start_year"),
+    end_year: int | None = Query(None, description="Only return students with study_year <= end_year"),
+    limit: int | None = Query(None, ge=1, description="Stop after this many students"),
+):
+    where = _year_range_where(start_year, end_year)
+    targets = _student_fragment_targets(start_year, end_year)
+    dbvs1_collections, dbvs2_collections, _, _ = await _open_student_fragments(targets)
 
-        students.append({
-            "id": mid,
-            "review": external_document,
-            "motivational_letter": internal_document,
-            "metadata": fields,
-        })
+    async def _rows():
+        async for entry in _merged_students(dbvs1_collections, dbvs2_collections, where, limit):
+            yield orjson.dumps(_merge_student(*entry), option=orjson.OPT_APPEND_NEWLINE)
 
-    return {"students": students}
+    return StreamingResponse(_rows(), media_type="application/x-ndjson")
 
 
 @app.post("/student/{student_id}/upgrade")
-def upgrade_student_year(student_id: int):
+async def upgrade_student_year(student_id: int):
     sid = str(student_id)
 
-    def locate_student(server_name: str):
-        found = None
-        for frag_type, frag_info in FRAGMENTS[server_name].items():
-            db_name = frag_info["database"]
-            client = get_client(server_name, db_name)
-            try:
-                collection = client.get_collection("students")
-            except Exception:
-                continue
-
-            data = collection.get(limit=None)
-            ids = data.get("ids", [])
-            docs = data.get("documents", [])
-            metas = data.get("metadatas", [])
-
-            if sid in ids:
-                idx = ids.index(sid)
-                doc = docs[idx]
-                meta = metas[idx] if idx < len(metas) and isinstance(metas[idx], dict) else {}
-                return {
-                    "db": db_name,
-                    "doc": doc,
-                    "meta": meta,
-                }
-        return None
+    async def locate_student(server_name: str):
+        return await _find_in_fragments(server_name, "students", sid, ["documents", "metadatas"])
 
     # Locate across both vertical fragments
-    s1 = locate_student("DBVS1")
-    s2 = locate_student("DBVS2")
+    s1, s2 = await asyncio.gather(locate_student("DBVS1"), locate_student("DBVS2"))
 
     if not s1 or not s2:
         raise HTTPException(status_code=404, detail=f"Student '{sid}' not found in all vertical fragments")
@@ -1034,7 +1746,7 @@ def upgrade_student_year(student_id: int):
     new_year = current_year + 1
 
     # Helper to apply update/move atomically within a server (with internal compensation)
-    def apply_on_server(server_name: str, doc: str, meta: dict):
+    async def apply_on_server(server_name: str, doc: str, meta: dict):
         old_db = resolve_fragment(server_name, current_year)
         new_db = resolve_fragment(server_name, new_year)
 
@@ -1043,65 +1755,68 @@ def upgrade_student_year(student_id: int):
         new_meta = dict(old_meta)
         new_meta["study_year"] = new_year
 
-        old_client = get_client(server_name, old_db)
-        old_col = old_client.get_or_create_collection("students")
+        old_col = await get_students_collection(server_name, old_db)
 
         if new_db == old_db:
             # In-place update
             try:
-                old_col.update(ids=[sid], metadatas=[new_meta], documents=[doc])
+                await old_col.update(ids=[sid], metadatas=[new_meta], documents=[doc])
                 return {"action": "update", "server": server_name, "db": old_db, "prev_meta": old_meta}
             except Exception as e:
                 raise HTTPException(status_code=500, detail=f"Failed to update {server_name}:{old_db}: {e}")
         else:
             # Move across horizontal fragments (add to new, then delete old). Compensate if delete fails
-            new_client = get_client(server_name, new_db)
-            new_col = new_client.get_or_create_collection("students")
+            new_col = await get_students_collection(server_name, new_db)
             try:
-                new_col.add(ids=[sid], documents=[doc], metadatas=[new_meta])
+                await new_col.add(ids=[sid], documents=[doc], metadatas=[new_meta])
             except Exception as e:
                 raise HTTPException(status_code=500, detail=f"Failed to add to {server_name}:{new_db}: {e}")
             try:
-                old_col.delete(ids=[sid])
+                await old_col.delete(ids=[sid])
             except Exception as e:
                 # Compensation: remove from new to revert
                 try:
-                    new_col.delete(ids=[sid])
+                    await new_col.delete(ids=[sid])
                 except Exception:
                     pass
                 raise HTTPException(status_code=500, detail=f"Failed to delete from {server_name}:{old_db}: {e}")
 
+            await remember_student_locations([((server_name, sid), new_db)])
             return {"action": "move", "server": server_name, "from": old_db, "to": new_db, "doc": doc, "prev_meta": old_meta}
 
-    # Apply on DBVS1 first, then DBVS2. If second fails, rollback first.
-    result1 = apply_on_server("DBVS1", s1["doc"], s1["meta"])
-    try:
-        result2 = apply_on_server("DBVS2", s2["doc"], s2["meta"])
-    except HTTPException as err:
-        # Rollback DBVS1
+    async def rollback_on_server(server_name: str, result: dict, doc: str):
         try:
-            if result1["action"] == "update":
-                db = result1["db"]
-                client = get_client("DBVS1", db)
-                col = client.get_or_create_collection("students")
-                col.update(ids=[sid], metadatas=[result1["prev_meta"]], documents=[s1["doc"]])
-            elif result1["action"] == "move":
+            if result["action"] == "update":
+                col = await get_students_collection(server_name, result["db"])
+                await col.update(ids=[sid], metadatas=[result["prev_meta"]], documents=[doc])
+            elif result["action"] == "move":
                 # Move back: add to original, delete from new
-                from_db = result1["from"]
-                to_db = result1["to"]
-                from_client = get_client("DBVS1", from_db)
-                to_client = get_client("DBVS1", to_db)
-                from_col = from_client.get_or_create_collection("students")
-                to_col = to_client.get_or_create_collection("students")
-                from_col.add(ids=[sid], documents=[result1["doc"]], metadatas=[result1["prev_meta"]])
+                from_col = await get_students_collection(server_name, result["from"])
+                to_col = await get_students_collection(server_name, result["to"])
+                await from_col.add(ids=[sid], documents=[result["doc"]], metadatas=[result["prev_meta"]])
+                await remember_student_locations([((server_name, sid), result["from"])])
                 try:
-                    to_col.delete(ids=[sid])
+                    await to_col.delete(ids=[sid])
                 except Exception:
                     pass
         except Exception:
             # If rollback fails, still return the original error to signal inconsistency
             pass
-        raise err
+
+    # Apply on both servers concurrently. If one side fails, roll back the side that succeeded.
+    result1, result2 = await asyncio.gather(
+        apply_on_server("DBVS1", s1["doc"], s1["meta"]),
+        apply_on_server("DBVS2", s2["doc"], s2["meta"]),
+        return_exceptions=True,
+    )
+    _STUDENTS_CACHE.clear()
+    for failed, ok, server_name, doc in ((result2, result1, "DBVS1", s1["doc"]), (result1, result2, "DBVS2", s2["doc"])):
+        if isinstance(failed, BaseException):
+            if not isinstance(ok, BaseException):
+                await rollback_on_server(server_name, ok, doc)
+            if isinstance(failed, HTTPException):
+                raise failed
+            raise HTTPException(status_code=500, detail=f"Failed to upgrade student '{sid}': {failed}")
 
     return {
         "message": "Student upgraded successfully",
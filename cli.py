@@ -1,5 +1,6 @@
 import chromadb
 from chromadb import Settings
+from concurrent.futures import ThreadPoolExecutor
 
 SERVERS = [
     {"name": "DBVS1", "host": "localhost", "port": 8000},
@@ -19,10 +20,10 @@ def get_client(host, port, tenant, database):
     )
 
 
-def print_collection_data(client, collection_name):
+def print_collection_data(client, collection_name, limit=20):
     try:
         collection = client.get_collection(collection_name)
-        data = collection.get(limit=None)
+        data = collection.get(limit=limit, include=["documents", "metadatas"])
 
         ids = data.get("ids", [])
         documents = data.get("documents", [])
@@ -32,7 +33,7 @@ def print_collection_data(client, collection_name):
             print(f"\nNo data found in '{collection_name}'.")
             return
 
-        print(f"\nShowing entries from '{collection_name}':")
+        print(f"\nShowing {len(documents)} of {collection.count()} entries from '{collection_name}':")
 
         for i, doc in enumerate(documents):
             print(f"\n  [{i+1}] ID: {ids[i] if i < len(ids) else 'N/A'}")
@@ -85,13 +86,18 @@ def main():
     ))
 
     print("\nChecking available databases...")
-    available_dbs = []
-    for db in DATABASES:
+
+    def database_exists(db):
         try:
             admin.get_database(db, "tenant_user:user12")
-            available_dbs.append(db)
+            return True
         except Exception:
-            continue
+            return False
+
+    # One round-trip per candidate, so probe them all at once
+    with ThreadPoolExecutor(max_workers=len(DATABASES)) as ex:
+        found = list(ex.map(database_exists, DATABASES))
+    available_dbs = [db for db, exists in zip(DATABASES, found) if exists]
 
     if not available_dbs:
         print("No databases found for this tenant.")
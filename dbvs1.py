@@ -1,15 +1,17 @@
+import asyncio
 import chromadb
 from chromadb import Settings
 from utils import (
     get_or_create_tenant_for_user,
-    import_csv_to_chroma
+    import_tables
 )
 
+HOST = "localhost"
 PORT = 8000
 
 admin = chromadb.AdminClient(Settings(
     chroma_api_impl="chromadb.api.fastapi.FastAPI",
-    chroma_server_host="localhost",
+    chroma_server_host=HOST,
     chroma_server_http_port=PORT,
 ))
 
@@ -25,11 +27,7 @@ DB12_FOLDER = "./DB12"
 TABLES11 = ["course_review", "students", "support_tickets", "support_responses"]
 TABLES12 = ["course_review", "students", "support_tickets", "support_responses"]
 
-for name in TABLES11:
-    import_csv_to_chroma(client_db11, DB11_FOLDER, name, f"{name}.csv")
-
-for name in TABLES12:
-    import_csv_to_chroma(client_db12, DB12_FOLDER, name, f"{name}.csv")
+asyncio.run(import_tables(tenant, HOST, PORT, [(db11, DB11_FOLDER, name) for name in TABLES11] + [(db12, DB12_FOLDER, name) for name in TABLES12]))
 
 print(client_db11.list_collections())
 print(client_db12.list_collections())
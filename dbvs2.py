@@ -1,15 +1,17 @@
+import asyncio
 import chromadb
 from chromadb import Settings
 from utils import (
     get_or_create_tenant_for_user,
-    import_csv_to_chroma
+    import_tables
 )
 
+HOST = "localhost"
 PORT = 8001
 
 admin = chromadb.AdminClient(Settings(
     chroma_api_impl="chromadb.api.fastapi.FastAPI",
-    chroma_server_host="localhost",
+    chroma_server_host=HOST,
     chroma_server_http_port=PORT,
 ))
 
@@ -25,11 +27,7 @@ DB22_FOLDER = "./DB22"
 TABLES21 = ["courses", "documents", "exams", "programs", "students"]
 TABLES22 = ["courses", "documents", "exams", "programs", "students"]
 
-for name in TABLES21:
-    import_csv_to_chroma(client_db21, DB21_FOLDER, name, f"{name}.csv")
-
-for name in TABLES22:
-    import_csv_to_chroma(client_db22, DB22_FOLDER, name, f"{name}.csv")
+asyncio.run(import_tables(tenant, HOST, PORT, [(db21, DB21_FOLDER, name) for name in TABLES21] + [(db22, DB22_FOLDER, name) for name in TABLES22]))
 
 print(client_db21.list_collections())
 print(client_db22.list_collections())
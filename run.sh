@@ -0,0 +1,12 @@
+#!/bin/sh
+# Serve the API with one uvicorn process per core.
+# Each worker imports api.py on its own, so the client and collection handle caches are
+# per-process. The student location index is shared through a SQLite file so every worker
+# routes by it.
+export STUDENT_LOCATIONS_DB="${STUDENT_LOCATIONS_DB:-student_locations.sqlite3}"
+exec uvicorn api:app \
+    --host "${HOST:-0.0.0.0}" \
+    --port "${PORT:-8002}" \
+    --workers "${WORKERS:-$(nproc)}" \
+    --loop uvloop \
+    --http httptools
@@ -1,8 +1,51 @@
+import asyncio
+import json
+from itertools import islice, zip_longest
+
 import pytest
+from chromadb.errors import NotFoundError
 from fastapi.testclient import TestClient
 
 # Import the app and function to patch
 import api as api_module
+import utils
+
+
+_WHERE_OPS = {
+    "$eq": lambda v, x: v == x,
+    "$ne": lambda v, x: v != x,
+    # Like Chroma, range operators never match string values
+    "$gt": lambda v, x: isinstance(v, (int, float)) and v > x,
+    "$gte": lambda v, x: isinstance(v, (int, float)) and v >= x,
+    "$lt": lambda v, x: isinstance(v, (int, float)) and v < x,
+    "$lte": lambda v, x: isinstance(v, (int, float)) and v <= x,
+    "$in": lambda v, x: v in x,
+    "$nin": lambda v, x: v not in x,
+}
+
+
+def matches_where(meta, where):
+    # Evaluates the subset of Chroma's metadata filter language used by the API
+    if not where:
+        return True
+    for key, cond in where.items():
+        if key == "$and":
+            if not all(matches_where(meta, c) for c in cond):
+                return False
+        elif key == "$or":
+            if not any(matches_where(meta, c) for c in cond):
+                return False
+        elif isinstance(cond, dict):
+            value = meta.get(key)
+            if not all(_WHERE_OPS[op](value, operand) for op, operand in cond.items()):
+                return False
+        elif meta.get(key) != cond:
+            return False
+    return True
+
+
+def fake_embedding(doc):
+    return [float(len(doc or ""))]
 
 
 class InMemoryCollection:
@@ -11,35 +54,63 @@ class InMemoryCollection:
         # backing: dict id -> {"document": str, "metadata": dict}
         self._store = backing
 
-    def add(self, ids, documents, metadatas):
-        for i, rid in enumerate(ids):
-            doc = documents[i] if i < len(documents) else None
-            meta = metadatas[i] if i < len(metadatas) else {}
-            self._store[str(rid)] = {"document": doc, "metadata": dict(meta or {})}
-
-    def get(self, limit=None, ids=None):
+    async def add(self, ids, documents, metadatas, embeddings=None):
+        # Like Chroma, an add never overwrites: ids that already exist are dropped
+        fresh = [i for i, rid in enumerate(ids) if str(rid) not in self._store]
+        self.put(
+            [ids[i] for i in fresh],
+            [documents[i] for i in fresh],
+            [metadatas[i] for i in fresh],
+            None if embeddings is None else [embeddings[i] for i in fresh],
+        )
+
+    async def upsert(self, ids, documents, metadatas, embeddings=None):
+        self.put(ids, documents, metadatas, embeddings)
+
+    def put(self, ids, documents, metadatas, embeddings=None):
+        # Rows only carry an "embedding" when the caller supplied one; otherwise Chroma would compute it
+        for rid, doc, meta, embedding in zip_longest(ids, documents, metadatas, embeddings or []):
+            row = {"document": doc, "metadata": dict(meta or {})}
+            if embedding is not None:
+                row["embedding"] = embedding
+            self._store[str(rid)] = row
+
+    async def get(self, limit=None, ids=None, where=None, include=None, offset=None):
         out_ids, docs, metas = [], [], []
         if ids is not None:
+            if not ids:
+                raise ValueError("Expected IDs to be a non-empty list")
             for rid in ids:
                 rid = str(rid)
-                if rid in self._store:
+                row = self._store.get(rid)
+                if row is not None and matches_where(row["metadata"], where):
                     out_ids.append(rid)
-                    docs.append(self._store[rid]["document"])
-                    metas.append(self._store[rid]["metadata"])
+                    docs.append(row["document"])
+                    metas.append(row["metadata"])
         else:
-            for rid, row in self._store.items():
-                out_ids.append(rid)
-                docs.append(row["document"])
-                metas.append(row["metadata"])
-                if isinstance(limit, int) and limit is not None and len(out_ids) >= limit:
-                    break
-        return {"ids": out_ids, "documents": docs, "metadatas": metas}
-
-    def delete(self, ids):
+            start = offset or 0
+            stop = start + limit if isinstance(limit, int) else None
+            matched = ((rid, row) for rid, row in self._store.items() if matches_where(row["metadata"], where))
+            rows = list(islice(matched, start, stop))
+            out_ids = [rid for rid, _ in rows]
+            docs = [row["document"] for _, row in rows]
+            metas = [row["metadata"] for _, row in rows]
+        embeddings = [fake_embedding(doc) for doc in docs]
+        # Chroma returns None for fields left out of include
+        if include is not None:
+            docs = docs if "documents" in include else None
+            metas = metas if "metadatas" in include else None
+        embeddings = embeddings if include and "embeddings" in include else None
+        return {"ids": out_ids, "documents": docs, "metadatas": metas, "embeddings": embeddings}
+
+    async def count(self):
+        return len(self._store)
+
+    async def delete(self, ids):
         for rid in ids:
             self._store.pop(str(rid), None)
 
-    def update(self, ids, documents=None, metadatas=None):
+    async def update(self, ids, documents=None, metadatas=None):
         for i, rid in enumerate(ids):
             rid = str(rid)
             if rid not in self._store:
@@ -51,89 +122,147 @@ class InMemoryCollection:
                 self._store[rid]["metadata"] = dict(metadatas[i] or {})
 
     # Minimal similarity that returns first n docs deterministically
-    def query(self, query_texts, n_results=5):
-        ids = list(self._store.keys())[:n_results]
+    async def query(self, query_texts=None, query_embeddings=None, n_results=5, include=None):
+        self.last_query = {"query_texts": query_texts, "query_embeddings": query_embeddings}
+        ids = list(islice(self._store, n_results))
         docs = [self._store[i]["document"] for i in ids]
         metas = [self._store[i]["metadata"] for i in ids]
         dists = [0.0 for _ in ids]
+        n_queries = len(query_texts if query_texts is not None else query_embeddings)
         return {
-            "ids": [ids],
-            "documents": [docs],
-            "metadatas": [metas],
-            "distances": [dists],
+            "ids": [ids] * n_queries,
+            "documents": [docs] * n_queries,
+            "metadatas": [metas] * n_queries,
+            "distances": [dists] * n_queries,
         }
 
 
 class InMemoryHttpClient:
     # Global registry across all client instances
     _registry = {}
+    # Subclasses swap this to hand out failing collections over the same stores
+    collection_class = InMemoryCollection
 
     def __init__(self, server_name, database):
         self.server_name = server_name
         self.database = database
-        key = (server_name, database)
-        if key not in self._registry:
-            self._registry[key] = {}
+        # Per-database store, looked up once instead of on every collection call
+        self._db = self._registry.setdefault((server_name, database), {})
 
     @classmethod
     def reset_all(cls):
         cls._registry = {}
 
-    def list_collections(self):
-        return [
-            {"name": name} for name in self._registry[(self.server_name, self.database)].keys()
-        ]
+    async def list_collections(self):
+        return [self.collection(name) for name in self._db]
 
-    def delete_collection(self, name):
-        self._registry[(self.server_name, self.database)].pop(name, None)
+    async def delete_collection(self, name):
+        self._db.pop(name, None)
 
-    def get_or_create_collection(self, name):
-        key = (self.server_name, self.database)
-        if name not in self._registry[key]:
-            self._registry[key][name] = {}
-        return InMemoryCollection(name, self._registry[key][name])
+    async def get_or_create_collection(self, name):
+        return self.collection(name)
 
-    def get_collection(self, name):
-        key = (self.server_name, self.database)
-        if name not in self._registry[key]:
-            raise RuntimeError(f"Collection '{name}' not found")
-        return InMemoryCollection(name, self._registry[key][name])
+    def collection(self, name):
+        return self.collection_class(name, self._db.setdefault(name, {}))
 
+    async def get_collection(self, name):
+        if name not in self._db:
+            raise NotFoundError(f"Collection [{name}] does not exist")
+        return self.collection_class(name, self._db[name])
 
-@pytest.fixture(autouse=True)
-def reset_registry():
-    InMemoryHttpClient.reset_all()
-    yield
 
+class FailingAddCollection(InMemoryCollection):
+    async def add(self, ids, documents, metadatas, embeddings=None):
+        raise RuntimeError("Simulated DBVS2 failure on add")
 
-@pytest.fixture()
-def test_client(monkeypatch):
-    # Patch api.get_client to our in-memory client
-    def fake_get_client(server_name: str, db_name: str):
-        return InMemoryHttpClient(server_name, db_name)
 
-    monkeypatch.setattr(api_module, "get_client", fake_get_client)
+class FailingDeleteCollection(InMemoryCollection):
+    async def delete(self, ids):
+        raise RuntimeError("Simulated DBVS2 deletion failure")
+
+
+class FailingSecondAddCollection(InMemoryCollection):
+    async def add(self, ids, documents, metadatas, embeddings=None):
+        self.adds = getattr(self, "adds", 0) + 1
+        if self.adds == 2:
+            raise RuntimeError("Simulated DBVS2 failure on second add")
+        await super().add(ids, documents, metadatas)
+
+
+class FailingGetCollection(InMemoryCollection):
+    async def get(self, **kwargs):
+        raise RuntimeError("Simulated fragment read failure")
+
+
+class FailingCountCollection(InMemoryCollection):
+    async def count(self):
+        raise RuntimeError("Simulated fragment count failure")
+
+
+class FailingAddClient(InMemoryHttpClient):
+    collection_class = FailingAddCollection
+
+
+class FailingDeleteClient(InMemoryHttpClient):
+    collection_class = FailingDeleteCollection
+
+
+class FailingSecondAddClient(InMemoryHttpClient):
+    collection_class = FailingSecondAddCollection
+
+
+class FailingGetClient(InMemoryHttpClient):
+    collection_class = FailingGetCollection
+
+
+class FailingCountClient(InMemoryHttpClient):
+    collection_class = FailingCountCollection
+
+
+async def fake_get_client(server_name: str, db_name: str):
+    return InMemoryHttpClient(server_name, db_name)
+
+
+@pytest.fixture(scope="module")
+def shared_client():
     return TestClient(api_module.app)
 
 
+@pytest.fixture()
+def test_client(shared_client, monkeypatch):
+    # Fresh in-memory servers and empty API caches, with api.get_client patched to reach them
+    InMemoryHttpClient.reset_all()
+    api_module._COLLECTIONS.clear()
+    api_module._MISSING_COLLECTIONS.clear()
+    api_module._STUDENTS_CACHE.clear()
+    api_module._ID_STATE.clear()
+    api_module.STUDENT_LOCATIONS.clear()
+    api_module._LOCATION_STORE.clear()
+    monkeypatch.setattr(api_module, "get_client", fake_get_client)
+    return shared_client
+
+
 def seed_student(client: InMemoryHttpClient, sid: str, doc: str, meta: dict):
-    col = client.get_or_create_collection("students")
-    col.add(ids=[sid], documents=[doc], metadatas=[meta])
+    col = client.collection("students")
+    col.put(ids=[sid], documents=[doc], metadatas=[meta])
 
 
 def seed_course(client: InMemoryHttpClient, cid: str, doc: str, meta: dict):
-    col = client.get_or_create_collection("courses")
-    col.add(ids=[cid], documents=[doc], metadatas=[meta])
+    col = client.collection("courses")
+    col.put(ids=[cid], documents=[doc], metadatas=[meta])
 
 
 def seed_review(client: InMemoryHttpClient, rid: str, doc: str, meta: dict):
-    col = client.get_or_create_collection("course_review")
-    col.add(ids=[rid], documents=[doc], metadatas=[meta])
+    col = client.collection("course_review")
+    col.put(ids=[rid], documents=[doc], metadatas=[meta])
+
+
+_EMPTY_STORE = {}
 
 
 def get_collection_store(server, db, name):
-    key = (server, db)
-    return InMemoryHttpClient._registry.get(key, {}).get(name, {})
+    # Read-only view for assertions; missing databases and collections read as empty
+    return InMemoryHttpClient._registry.get((server, db), _EMPTY_STORE).get(name, _EMPTY_STORE)
 
 
 def test_insert_student_success(test_client):
@@ -158,29 +287,26 @@ def test_insert_student_success(test_client):
     assert sid in s2
 
 
-def test_insert_student_dbvs2_failure_rolls_back_dbvs1(test_client, monkeypatch):
-    # Force DBVS2 add to raise
-    original_get_client = api_module.get_client
+def test_insert_student_rejects_non_integer_study_year(test_client):
+    meta = {"name": "A", "surname": "B", "email": "a@b.c", "final_score": 7.0}
+    for study_year in ("second", None):
+        resp = test_client.post("/student", json={"document": "doc", "metadata": {**meta, "study_year": study_year}})
+        assert resp.status_code == 400
+        assert resp.json()["detail"] == "study_year must be an integer"
 
-    def failing_dbvs2_client(server_name, db_name):
-        base = InMemoryHttpClient(server_name, db_name)
-        if server_name == "DBVS2":
-            # Wrap the collection to raise on add
-            class FailingAdd(InMemoryCollection):
-                def add(self, ids, documents, metadatas):
-                    raise RuntimeError("Simulated DBVS2 failure on add")
+    resp = test_client.post("/student", json={"document": "doc", "metadata": meta})
+    assert resp.status_code == 400
 
-            class Proxy(InMemoryHttpClient):
-                def get_or_create_collection(self, name):
-                    col = super().get_or_create_collection(name)
-                    return FailingAdd(col.name, col._store)
+    resp = test_client.post("/student", json={"document": "doc", "metadata": {**meta, "study_year": "2"}})
+    assert resp.status_code == 200, resp.text
 
-                def get_collection(self, name):
-                    col = super().get_collection(name)
-                    return FailingAdd(col.name, col._store)
 
-            return Proxy(server_name, db_name)
-        return base
+def test_insert_student_dbvs2_failure_rolls_back_dbvs1(test_client, monkeypatch):
+    # Force DBVS2 add to raise
+    async def failing_dbvs2_client(server_name, db_name):
+        if server_name == "DBVS2":
+            return FailingAddClient(server_name, db_name)
+        return InMemoryHttpClient(server_name, db_name)
 
     monkeypatch.setattr(api_module, "get_client", failing_dbvs2_client)
 
@@ -241,6 +367,12 @@ def test_upgrade_student_year_moves_across_fragments(test_client):
     assert sid not in get_collection_store("DBVS2", "db21", "students")
     assert sid in get_collection_store("DBVS2", "db22", "students")
 
+    # The location index follows the move, and a stale hint still resolves via the fan-out
+    assert api_module.STUDENT_LOCATIONS[("DBVS1", sid)] == "db12"
+    api_module.STUDENT_LOCATIONS[("DBVS2", sid)] = "db21"
+    assert test_client.delete(f"/student/{sid}").status_code == 200
+    assert sid not in get_collection_store("DBVS2", "db22", "students")
+
 
 def test_delete_course_deletes_related_reviews(test_client):
     # Seed course 16 in db22 and related reviews in db12
@@ -263,26 +395,10 @@ def test_delete_student_success_with_rollback_on_second_delete(test_client, monk
     seed_student(InMemoryHttpClient("DBVS2", "db21"), sid, "doc2", {"student_id": 202, "name": "A", "surname": "B", "email": "a@b.c", "study_year": 1})
 
     # Make DBVS2 deletion fail
-    orig_get_client = api_module.get_client
-
-    class FailingDeleteCollection(InMemoryCollection):
-        def delete(self, ids):
-            raise RuntimeError("Simulated DBVS2 deletion failure")
-
-    def patched_get_client(server_name, db_name):
-        base = InMemoryHttpClient(server_name, db_name)
+    async def patched_get_client(server_name, db_name):
         if server_name == "DBVS2":
-            class Proxy(InMemoryHttpClient):
-                def get_or_create_collection(self, name):
-                    col = super().get_or_create_collection(name)
-                    return FailingDeleteCollection(col.name, col._store)
-
-                def get_collection(self, name):
-                    col = super().get_collection(name)
-                    return FailingDeleteCollection(col.name, col._store)
-
-            return Proxy(server_name, db_name)
-        return base
+            return FailingDeleteClient(server_name, db_name)
+        return InMemoryHttpClient(server_name, db_name)
 
     monkeypatch.setattr(api_module, "get_client", patched_get_client)
 
@@ -294,17 +410,74 @@ def test_delete_student_success_with_rollback_on_second_delete(test_client, monk
     assert sid in s1
 
 
+def test_support_ticket_queries_policies_with_stored_embedding(test_client):
+    InMemoryHttpClient("DBVS1", "db12").collection("support_tickets").put(["t1"], ["cannot log in"], [{}])
+    InMemoryHttpClient("DBVS2", "db22").collection("documents").put(["p1", "p2"], ["password policy", "refund policy"], [{}, {}])
+
+    resp = test_client.get("/support_ticket/t1", params={"top_k": 1})
+    assert resp.status_code == 200, resp.text
+    assert [d["id"] for d in resp.json()["documents"]] == ["p1"]
+
+    last_query = api_module._COLLECTIONS[("DBVS2", "db22", "documents")].last_query
+    assert last_query == {"query_texts": None, "query_embeddings": [fake_embedding("cannot log in")]}
+
+
+def test_concurrent_support_ticket_lookups_share_one_query(test_client, monkeypatch):
+    InMemoryHttpClient("DBVS1", "db11").collection("support_tickets").put(["t1", "t2"], ["a", "bb"], [{}, {}])
+    InMemoryHttpClient("DBVS2", "db21").collection("documents").put(["p1"], ["internal policy"], [{}])
+    queries = []
+    original_query = InMemoryCollection.query
+
+    async def counting_query(self, **kwargs):
+        queries.append(kwargs["query_embeddings"])
+        return await original_query(self, **kwargs)
+
+    monkeypatch.setattr(InMemoryCollection, "query", counting_query)
+
+    async def lookup_two():
+        return await asyncio.gather(
+            api_module.find_related_document_to_policy("t1", top_k=1),
+            api_module.find_related_document_to_policy("t2", top_k=1),
+        )
+
+    results = asyncio.run(lookup_two())
+    assert [[d["id"] for d in r["documents"]] for r in results] == [["p1"], ["p1"]]
+    assert queries == [[fake_embedding("a"), fake_embedding("bb")]]
+
+
+def test_support_tickets_batch_queries_once_per_fragment(test_client):
+    InMemoryHttpClient("DBVS1", "db11").collection("support_tickets").put(["t1", "t2"], ["a", "bb"], [{}, {}])
+    InMemoryHttpClient("DBVS1", "db12").collection("support_tickets").put(["t3"], ["ccc"], [{}])
+    InMemoryHttpClient("DBVS2", "db21").collection("documents").put(["p1"], ["internal policy"], [{}])
+    InMemoryHttpClient("DBVS2", "db22").collection("documents").put(["p2"], ["external policy"], [{}])
+
+    resp = test_client.post("/support_tickets/batch", json={"ticket_ids": ["t1", "t3", "t2", "nope"], "top_k": 1})
+    assert resp.status_code == 200, resp.text
+    data = resp.json()
+    assert {tid: [d["id"] for d in hits] for tid, hits in data["results"].items()} == {
+        "t1": ["p1"], "t2": ["p1"], "t3": ["p2"],
+    }
+    assert data["missing"] == ["nope"]
+
+    last_query = api_module._COLLECTIONS[("DBVS2", "db21", "documents")].last_query
+    assert last_query["query_embeddings"] == [fake_embedding("a"), fake_embedding("bb")]
+
+    resp = test_client.post("/support_tickets/batch", json={"ticket_ids": []})
+    assert resp.status_code == 200, resp.text
+    assert resp.json() == {"results": {}, "missing": []}
+
+
 def test_move_course_transfers_related_entities_and_reviews(test_client):
     # Seed course 5 in DBVS2:db21 with linked exam_id=5 and program_id=5
     c_db21 = InMemoryHttpClient("DBVS2", "db21")
     seed_course(c_db21, "5", "Database Systems", {"name": "Database Systems", "exam_id": 5, "program_id": 5})
 
     # Seed related exam and program in db21
-    exams_col = c_db21.get_or_create_collection("exams")
-    exams_col.add(ids=["5"], documents=["Database Final"], metadatas=[{"course_id": 5, "name": "Database Final", "passing_score": 8.8}])
+    exams_col = c_db21.collection("exams")
+    exams_col.put(ids=["5"], documents=["Database Final"], metadatas=[{"course_id": 5, "name": "Database Final", "passing_score": 8.8}])
 
-    progs_col = c_db21.get_or_create_collection("programs")
-    progs_col.add(ids=["5"], documents=["Data Science"], metadatas=[{"name": "Data Science"}])
+    progs_col = c_db21.collection("programs")
+    progs_col.put(ids=["5"], documents=["Data Science"], metadatas=[{"name": "Data Science"}])
 
     # Seed two course reviews in DBVS1:db11 with course_id 5
     r_db11 = InMemoryHttpClient("DBVS1", "db11")
@@ -322,15 +495,399 @@ def test_move_course_transfers_related_entities_and_reviews(test_client):
     assert out["to_dbvs1"] == "db12"
 
     # DBVS2 assertions: course/exam/program removed from db21 and present in db22
-    assert "5" not in get_collection_store("DBVS2", "db21", "courses")
-    assert "5" in get_collection_store("DBVS2", "db22", "courses")
-    assert "5" not in get_collection_store("DBVS2", "db21", "exams")
-    assert "5" in get_collection_store("DBVS2", "db22", "exams")
-    assert "5" not in get_collection_store("DBVS2", "db21", "programs")
-    assert "5" in get_collection_store("DBVS2", "db22", "programs")
+    for name in ("courses", "exams", "programs"):
+        assert "5" not in get_collection_store("DBVS2", "db21", name), name
+        assert "5" in get_collection_store("DBVS2", "db22", name), name
 
     # DBVS1 assertions: reviews moved from db11 to db12
-    assert "rv1" not in get_collection_store("DBVS1", "db11", "course_review")
-    assert "rv2" not in get_collection_store("DBVS1", "db11", "course_review")
-    assert "rv1" in get_collection_store("DBVS1", "db12", "course_review")
-    assert "rv2" in get_collection_store("DBVS1", "db12", "course_review")
+    assert not {"rv1", "rv2"} & get_collection_store("DBVS1", "db11", "course_review").keys()
+    assert {"rv1", "rv2"} <= get_collection_store("DBVS1", "db12", "course_review").keys()
+
+
+def test_get_all_students_merges_vertical_fragments(test_client):
+    seed_student(InMemoryHttpClient("DBVS1", "db11"), "1", "review 1", {"final_score": 8.0, "study_year": 1})
+    seed_student(InMemoryHttpClient("DBVS2", "db21"), "1", "letter 1", {"student_id": 1, "name": "A", "surname": "B", "email": "a@b.c", "study_year": 1})
+    seed_student(InMemoryHttpClient("DBVS2", "db22"), "12", "letter 12", {"student_id": 12, "name": "C", "surname": "D", "email": "c@d.e", "study_year": 4})
+
+    resp = test_client.get("/students")
+    assert resp.status_code == 200, resp.text
+    students = {s["id"]: s for s in resp.json()["students"]}
+    assert set(students) == {"1", "12"}
+
+    assert students["1"]["review"] == "review 1"
+    assert students["1"]["motivational_letter"] == "letter 1"
+    assert students["1"]["metadata"]["final_score"] == 8.0
+    assert students["1"]["metadata"]["name"] == "A"
+
+    assert students["12"]["review"] is None
+    assert students["12"]["metadata"]["email"] == "c@d.e"
+
+    resp = test_client.get("/students", params={"format": "columns"})
+    assert resp.status_code == 200, resp.text
+    data = resp.json()
+    assert data["count"] == 2
+    cols = data["columns"]
+    i = cols["ids"].index("1")
+    assert cols["reviews"][i] == "review 1"
+    assert cols["motivational_letters"][i] == "letter 1"
+    assert cols["metadatas"][i]["name"] == "A"
+
+
+def test_get_all_students_filters_by_year_range(test_client, monkeypatch):
+    monkeypatch.setattr(api_module, "STUDENTS_PAGE_SIZE", 1)
+    seed_student(InMemoryHttpClient("DBVS1", "db11"), "1", "r1", {"final_score": 8.0, "study_year": 1})
+    seed_student(InMemoryHttpClient("DBVS1", "db11"), "2", "r2", {"final_score": 7.0, "study_year": 2})
+    seed_student(InMemoryHttpClient("DBVS1", "db12"), "3", "r3", {"final_score": 9.0, "study_year": 4})
+
+    resp = test_client.get("/students", params={"start_year": 2, "end_year": 3})
+    assert resp.status_code == 200, resp.text
+    assert [s["id"] for s in resp.json()["students"]] == ["2"]
+
+    resp = test_client.get("/students", params={"start_year": 3})
+    assert [s["id"] for s in resp.json()["students"]] == ["3"]
+
+    resp = test_client.get("/students", params={"end_year": 2})
+    assert sorted(s["id"] for s in resp.json()["students"]) == ["1", "2"]
+
+
+def test_get_all_students_skips_failing_fragments(test_client, monkeypatch):
+    seed_student(InMemoryHttpClient("DBVS1", "db11"), "1", "r1", {"final_score": 8.0, "study_year": 1})
+    seed_student(InMemoryHttpClient("DBVS2", "db21"), "1", "l1", {"student_id": 1, "study_year": 1})
+    seed_student(InMemoryHttpClient("DBVS1", "db12"), "2", "r2", {"final_score": 9.0, "study_year": 3})
+    seed_student(InMemoryHttpClient("DBVS2", "db22"), "2", "l2", {"student_id": 2, "study_year": 3})
+
+    for client_class in (FailingGetClient, FailingCountClient):
+        api_module._COLLECTIONS.clear()
+
+        async def patched_get_client(server_name, db_name):
+            if (server_name, db_name) == ("DBVS1", "db12"):
+                return client_class(server_name, db_name)
+            return InMemoryHttpClient(server_name, db_name)
+
+        monkeypatch.setattr(api_module, "get_client", patched_get_client)
+
+        resp = test_client.get("/students")
+        assert resp.status_code == 200, resp.text
+        students = {s["id"]: s for s in resp.json()["students"]}
+        assert set(students) == {"1", "2"}
+        assert students["1"]["review"] == "r1"
+        assert students["2"]["review"] is None and students["2"]["motivational_letter"] == "l2"
+
+        columns = test_client.get("/students", params={"format": "columns"}).json()["columns"]
+        assert sorted(columns["ids"]) == ["1", "2"]
+
+    # Partial bodies are not cached
+    api_module._COLLECTIONS.clear()
+    monkeypatch.setattr(api_module, "get_client", fake_get_client)
+    students = {s["id"]: s for s in test_client.get("/students").json()["students"]}
+    assert students["2"]["review"] == "r2"
+
+
+def test_lookup_survives_a_failing_fragment(test_client, monkeypatch):
+    seed_student(InMemoryHttpClient("DBVS1", "db11"), "1", "r1", {"final_score": 8.0, "study_year": 1})
+    seed_student(InMemoryHttpClient("DBVS1", "db12"), "2", "r2", {"final_score": 9.0, "study_year": 3})
+
+    async def patched_get_client(server_name, db_name):
+        if (server_name, db_name) == ("DBVS1", "db11"):
+            return FailingGetClient(server_name, db_name)
+        return InMemoryHttpClient(server_name, db_name)
+
+    monkeypatch.setattr(api_module, "get_client", patched_get_client)
+
+    hit = asyncio.run(api_module._find_in_fragments("DBVS1", "students", "2", ["documents", "metadatas"]))
+    assert hit["db"] == "db12" and hit["doc"] == "r2"
+
+    # With no hit anywhere, the failed read is reported instead of "not found"
+    with pytest.raises(RuntimeError):
+        asyncio.run(api_module._find_in_fragments("DBVS1", "students", "9", ["documents", "metadatas"]))
+
+
+def test_missing_fragment_is_probed_once(test_client, monkeypatch):
+    seed_student(InMemoryHttpClient("DBVS1", "db11"), "1", "r1", {"final_score": 8.0, "study_year": 1})
+    probes = []
+    original = InMemoryHttpClient.get_collection
+
+    async def counting_get_collection(self, name):
+        probes.append((self.database, name))
+        return await original(self, name)
+
+    monkeypatch.setattr(InMemoryHttpClient, "get_collection", counting_get_collection)
+
+    for _ in range(2):
+        resp = test_client.get("/students")
+        assert [s["id"] for s in resp.json()["students"]] == ["1"]
+    assert probes.count(("db12", "students")) == 1
+
+    # Once the negative entry expires, a fragment created elsewhere is picked up
+    seed_student(InMemoryHttpClient("DBVS1", "db12"), "3", "r3", {"final_score": 9.0, "study_year": 3})
+    monkeypatch.setattr(api_module, "COLLECTION_MISS_TTL", 0.0)
+    resp = test_client.get("/students")
+    assert sorted(s["id"] for s in resp.json()["students"]) == ["1", "3"]
+
+
+def test_get_all_students_reuses_body_until_counts_change(test_client):
+    seed_student(InMemoryHttpClient("DBVS1", "db11"), "1", "r1", {"final_score": 8.0, "study_year": 1})
+    assert test_client.get("/students").json()["students"][0]["review"] == "r1"
+
+    # Same row counts: the cached body is served
+    get_collection_store("DBVS1", "db11", "students")["1"]["document"] = "edited"
+    assert test_client.get("/students").json()["students"][0]["review"] == "r1"
+
+    seed_student(InMemoryHttpClient("DBVS1", "db11"), "2", "r2", {"final_score": 7.0, "study_year": 2})
+    students = {s["id"]: s for s in test_client.get("/students").json()["students"]}
+    assert students["1"]["review"] == "edited"
+    assert set(students) == {"1", "2"}
+
+
+def test_prewarm_lists_each_fragment_once(test_client):
+    seed_student(InMemoryHttpClient("DBVS1", "db11"), "1", "r1", {"final_score": 8.0, "study_year": 1})
+
+    asyncio.run(api_module.prewarm_collections())
+
+    assert ("DBVS1", "db11", "students") in api_module._COLLECTIONS
+    assert ("DBVS1", "db12", "students") in api_module._MISSING_COLLECTIONS
+    assert ("DBVS1", "db11", "students") not in api_module._MISSING_COLLECTIONS
+
+
+def test_year_range_sees_rows_written_elsewhere(test_client):
+    seed_student(InMemoryHttpClient("DBVS1", "db11"), "1", "r1", {"final_score": 8.0, "study_year": 1})
+    seed_student(InMemoryHttpClient("DBVS2", "db21"), "1", "l1", {"student_id": 1, "name": "A", "surname": "B", "email": "a@b.c", "study_year": 1})
+
+    resp = test_client.get("/students", params={"start_year": 2, "end_year": 2})
+    assert resp.json()["students"] == []
+
+    # Written by another worker, with study_year as a string the way the CSV loaders store it
+    seed_student(InMemoryHttpClient("DBVS1", "db11"), "2", "r2", {"final_score": 6.0, "study_year": "2"})
+    seed_student(InMemoryHttpClient("DBVS2", "db21"), "2", "l2", {"student_id": 2, "name": "C", "surname": "D", "email": "c@d.e", "study_year": 2})
+
+    resp = test_client.get("/students", params={"start_year": 2, "end_year": 2})
+    [student] = resp.json()["students"]
+    assert student["id"] == "2"
+    assert student["review"] == "r2"
+    assert student["metadata"]["final_score"] == 6.0
+
+    body = {
+        "document": "doc",
+        "metadata": {"name": "C", "surname": "D", "email": "c@d.e", "final_score": 7.5, "study_year": 2},
+    }
+    sid = str(test_client.post("/student", json=body).json()["student_id"])
+
+    resp = test_client.get("/students", params={"start_year": 2, "end_year": 2})
+    assert sorted(s["id"] for s in resp.json()["students"]) == sorted(["2", sid])
+
+
+def test_stream_students_pages_and_merges_fragments(test_client, monkeypatch):
+    monkeypatch.setattr(api_module, "STUDENTS_PAGE_SIZE", 1)
+    for sid, year in (("1", 1), ("2", 2), ("3", 3)):
+        db1, db2 = ("db11", "db21") if year <= 2 else ("db12", "db22")
+        seed_student(InMemoryHttpClient("DBVS1", db1), sid, f"r{sid}", {"final_score": 8.0, "study_year": year})
+        seed_student(InMemoryHttpClient("DBVS2", db2), sid, f"l{sid}", {"student_id": int(sid), "name": "N", "surname": "S", "email": "e@x.y", "study_year": year})
+    # Only present in DBVS2
+    seed_student(InMemoryHttpClient("DBVS2", "db21"), "4", "l4", {"student_id": 4, "name": "O", "surname": "P", "email": "o@p.q", "study_year": 1})
+
+    resp = test_client.get("/students/stream")
+    assert resp.status_code == 200, resp.text
+    rows = [json.loads(line) for line in resp.text.splitlines()]
+    assert [r["id"] for r in rows] == ["1", "2", "3", "4"]
+    assert rows[0]["review"] == "r1" and rows[0]["motivational_letter"] == "l1"
+    assert rows[3]["review"] is None and rows[3]["metadata"]["name"] == "O"
+
+    resp = test_client.get("/students/stream", params={"start_year": 2, "limit": 1})
+    assert [json.loads(line)["id"] for line in resp.text.splitlines()] == ["2"]
+
+
+def test_concurrent_student_adds_share_one_call_per_fragment(test_client, monkeypatch):
+    add_calls = []
+    original_add = InMemoryCollection.add
+
+    async def counting_add(self, ids, documents, metadatas):
+        add_calls.append(list(ids))
+        await original_add(self, ids, documents, metadatas)
+
+    monkeypatch.setattr(InMemoryCollection, "add", counting_add)
+
+    async def insert_two():
+        return await asyncio.gather(
+            api_module._add_student_halves("db11", "db21", ["1"], ["d1"], [{"study_year": 1}], [{"study_year": 1}]),
+            api_module._add_student_halves("db11", "db21", ["2"], ["d2"], [{"study_year": 2}], [{"study_year": 2}]),
+        )
+
+    assert asyncio.run(insert_two()) == [None, None]
+    assert add_calls == [["1", "2"], ["1", "2"]]
+    assert set(get_collection_store("DBVS2", "db21", "students")) == {"1", "2"}
+
+
+def test_recover_student_inserts_drops_half_written_rows(test_client):
+    seed_student(InMemoryHttpClient("DBVS1", "db11"), "1", "r1", {"final_score": 8.0, "study_year": 1})
+    seed_student(InMemoryHttpClient("DBVS2", "db21"), "1", "l1", {"student_id": 1, "study_year": 1})
+    seed_student(InMemoryHttpClient("DBVS1", "db11"), "2", "r2", {"final_score": 7.0, "study_year": 1})
+    InMemoryHttpClient("DBVS1", "db11").collection("students_tx").put(
+        ["tx"], ["insert"], [{"dbvs1": "db11", "dbvs2": "db21", "ids": '["1", "2"]', "started": 0.0}]
+    )
+
+    asyncio.run(api_module.recover_student_inserts())
+
+    assert set(get_collection_store("DBVS1", "db11", "students")) == {"1"}
+    assert set(get_collection_store("DBVS2", "db21", "students")) == {"1"}
+    assert get_collection_store("DBVS1", "db11", "students_tx") == {}
+
+
+def test_student_locations_persist_to_sqlite(test_client, monkeypatch, tmp_path):
+    monkeypatch.setattr(api_module, "STUDENT_LOCATIONS_DB", str(tmp_path / "locations.sqlite3"))
+    body = {
+        "document": "doc",
+        "metadata": {"name": "A", "surname": "B", "email": "a@b.c", "final_score": 7.5, "study_year": 3},
+    }
+    sid = str(test_client.post("/student", json=body).json()["student_id"])
+
+    # A fresh process only has the file to go on
+    api_module.STUDENT_LOCATIONS.clear()
+    api_module._LOCATION_STORE.clear()
+    assert asyncio.run(api_module.student_location("DBVS1", sid)) == "db12"
+    assert asyncio.run(api_module.student_location("DBVS2", sid)) == "db22"
+
+    assert test_client.delete(f"/student/{sid}").status_code == 200
+    api_module.STUDENT_LOCATIONS.clear()
+    assert asyncio.run(api_module.student_location("DBVS1", sid)) is None
+
+
+def test_unusable_location_index_never_fails_requests(test_client, monkeypatch, tmp_path):
+    monkeypatch.setattr(api_module, "STUDENT_LOCATIONS_DB", str(tmp_path / "missing" / "locations.sqlite3"))
+    body = {
+        "document": "doc",
+        "metadata": {"name": "A", "surname": "B", "email": "a@b.c", "final_score": 7.5, "study_year": 3},
+    }
+    resp = test_client.post("/student", json=body)
+    assert resp.status_code == 200, resp.text
+    sid = str(resp.json()["student_id"])
+
+    # The in-process index still works without the file
+    assert api_module.STUDENT_LOCATIONS[("DBVS1", sid)] == "db12"
+    assert test_client.delete(f"/student/{sid}").status_code == 200
+
+
+def test_insert_students_bulk_groups_by_fragment(test_client, monkeypatch):
+    monkeypatch.setattr(api_module, "STUDENT_ADD_CHUNK", 1)
+
+    def item(name, year):
+        return {
+            "document": f"{name} profile",
+            "metadata": {"name": name, "surname": "X", "email": f"{name}@example.com", "final_score": 7.0, "study_year": year},
+        }
+
+    body = {"items": [item("A", 1), item("B", 3), item("C", 2)]}
+    resp = test_client.post("/students/bulk", json=body)
+    assert resp.status_code == 200, resp.text
+    data = resp.json()
+    assert data["inserted"] == 3 and data["failed"] == 0
+
+    assert set(get_collection_store("DBVS1", "db11", "students")) == {"1", "3"}
+    assert set(get_collection_store("DBVS2", "db21", "students")) == {"1", "3"}
+    assert set(get_collection_store("DBVS1", "db12", "students")) == {"2"}
+    assert get_collection_store("DBVS2", "db22", "students")["2"]["metadata"]["student_id"] == 2
+
+    resp = test_client.post("/students/bulk", json={"items": [item("D", 1), item("E", 9)]})
+    assert resp.status_code == 400
+    assert resp.json()["detail"].startswith("items[1]")
+
+
+def test_insert_students_bulk_undoes_partial_chunks(test_client, monkeypatch):
+    monkeypatch.setattr(api_module, "STUDENT_ADD_CHUNK", 1)
+
+    async def failing_dbvs2_client(server_name, db_name):
+        if server_name == "DBVS2":
+            return FailingSecondAddClient(server_name, db_name)
+        return InMemoryHttpClient(server_name, db_name)
+
+    monkeypatch.setattr(api_module, "get_client", failing_dbvs2_client)
+
+    items = [
+        {
+            "document": f"{name} profile",
+            "metadata": {"name": name, "surname": "X", "email": f"{name}@example.com", "final_score": 7.0, "study_year": 1},
+        }
+        for name in ("A", "B")
+    ]
+    resp = test_client.post("/students/bulk", json={"items": items})
+    assert resp.json()["failed"] == 2
+
+    # DBVS2 wrote its first chunk before failing; both servers end empty and the intent is cleared
+    assert get_collection_store("DBVS1", "db11", "students") == {}
+    assert get_collection_store("DBVS2", "db21", "students") == {}
+    assert get_collection_store("DBVS1", "db11", "students_tx") == {}
+
+
+def test_student_ids_come_from_reserved_block(test_client):
+    seed_student(InMemoryHttpClient("DBVS1", "db12"), "41", "r", {"final_score": 5.0, "study_year": 3})
+    body = {
+        "document": "profile",
+        "metadata": {"name": "A", "surname": "B", "email": "a@b.c", "final_score": 6.0, "study_year": 1},
+    }
+    assert test_client.post("/student", json=body).json()["student_id"] == 42
+    meta_store = get_collection_store("DBVS1", "db11", "students_meta")
+    assert meta_store["counter"]["metadata"]["high"] == api_module.STUDENT_ID_BLOCK
+    # Bookkeeping rows bring their own embedding, so the client never embeds them
+    assert all("embedding" in row for row in meta_store.values())
+
+    # Later inserts come from the counter, not a rescan
+    seed_student(InMemoryHttpClient("DBVS1", "db12"), "500", "r", {"final_score": 5.0, "study_year": 3})
+    assert test_client.post("/student", json=body).json()["student_id"] == 43
+
+    # A restarted process resumes from the persisted high-water mark
+    api_module._ID_STATE.clear()
+    assert test_client.post("/student", json=body).json()["student_id"] == api_module.STUDENT_ID_BLOCK
+
+
+def test_workers_never_share_student_ids(test_client, monkeypatch):
+    monkeypatch.setattr(api_module, "STUDENT_ID_BLOCK", 3)
+
+    # Each worker is a separate process: its own counter state and claim token
+    workers = {"A": {}, "B": {}}
+
+    def reserve(worker, count):
+        monkeypatch.setattr(api_module, "_ID_STATE", workers[worker])
+        monkeypatch.setattr(api_module, "_ID_OWNER", worker)
+        first = asyncio.run(api_module._reserve_student_ids(count))
+        return list(range(first, first + count))
+
+    handed_out = reserve("A", 2) + reserve("B", 1) + reserve("A", 3) + reserve("B", 3) + reserve("A", 1)
+    assert len(handed_out) == len(set(handed_out))
+
+
+class RecordingAdminClient:
+    # One Chroma server's tenants and databases, recording every admin call
+    def __init__(self):
+        self.databases = {}
+        self.calls = []
+
+    def get_tenant(self, tenant_id):
+        self.calls.append("get_tenant")
+        if tenant_id not in self.databases:
+            raise NotFoundError(f"Tenant {tenant_id} not found")
+
+    def create_tenant(self, tenant_id):
+        self.calls.append("create_tenant")
+        self.databases[tenant_id] = set()
+
+    def get_database(self, db_name, tenant_id):
+        self.calls.append("get_database")
+        if db_name not in self.databases[tenant_id]:
+            raise NotFoundError(f"Database {db_name} not found")
+
+    def create_database(self, db_name, tenant_id):
+        self.calls.append("create_database")
+        self.databases[tenant_id].add(db_name)
+
+
+def test_tenants_are_provisioned_on_every_server(monkeypatch):
+    monkeypatch.setattr(utils, "_SEEN_TENANTS", set())
+    monkeypatch.setattr(utils, "_SEEN_DATABASES", set())
+    dbvs1_admin, dbvs2_admin = RecordingAdminClient(), RecordingAdminClient()
+
+    assert utils.get_or_create_tenant_for_user(dbvs1_admin, "user12", "db11") == ("tenant_user:user12", "db11")
+    utils.get_or_create_tenant_for_user(dbvs2_admin, "user12", "db11")
+    assert dbvs1_admin.databases == dbvs2_admin.databases == {"tenant_user:user12": {"db11"}}
+
+    # Repeat calls against the same server skip the admin round trips
+    utils.get_or_create_tenant_for_user(dbvs1_admin, "user12", "db11")
+    assert dbvs1_admin.calls == ["get_tenant", "create_tenant", "get_database", "create_database"]
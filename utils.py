@@ -1,75 +1,148 @@
 import chromadb
 from chromadb import Settings
-import os, csv, json, uuid
+import os, csv
+import orjson
+from itertools import islice
+from collections import deque
+import asyncio
+
+# Rows per collection.add; Chroma handles batches of a few hundred rows best
+IMPORT_BATCH = 200
+# Chunk adds kept in flight per collection while importing
+IMPORT_CONCURRENCY = 4
+# Read buffer for CSV files, so large imports need far fewer read calls
+IMPORT_READ_BUFFER = 1 << 20
+
+# (admin client, tenant) and (admin client, tenant, database) already confirmed, so repeat calls skip the admin
+# round trips. Keyed by the admin client because each one talks to its own server.
+_SEEN_TENANTS = set()
+_SEEN_DATABASES = set()
 
 def get_or_create_tenant_for_user(admin_client, user_id, db_name):
     tenant_id = f"tenant_user:{user_id}"
 
-    try:
-        admin_client.get_tenant(tenant_id)
-        print(f"Tenant '{tenant_id}' already exists.")
-    except Exception:
-        print(f"Creating tenant '{tenant_id}'...")
-        admin_client.create_tenant(tenant_id)
+    if (admin_client, tenant_id) not in _SEEN_TENANTS:
+        try:
+            admin_client.get_tenant(tenant_id)
+            print(f"Tenant '{tenant_id}' already exists.")
+        except Exception:
+            print(f"Creating tenant '{tenant_id}'...")
+            admin_client.create_tenant(tenant_id)
+        _SEEN_TENANTS.add((admin_client, tenant_id))
 
-    try:
-        admin_client.get_database(db_name, tenant_id)
-        print(f"Database '{db_name}' already exists for tenant '{tenant_id}'.")
-    except Exception:
-        print(f"Creating database '{db_name}' for tenant '{tenant_id}'...")
-        admin_client.create_database(db_name, tenant_id)
+    if (admin_client, tenant_id, db_name) not in _SEEN_DATABASES:
+        try:
+            admin_client.get_database(db_name, tenant_id)
+            print(f"Database '{db_name}' already exists for tenant '{tenant_id}'.")
+        except Exception:
+            print(f"Creating database '{db_name}' for tenant '{tenant_id}'...")
+            admin_client.create_database(db_name, tenant_id)
+        _SEEN_DATABASES.add((admin_client, tenant_id, db_name))
 
     return tenant_id, db_name
 
-def import_csv_to_chroma(client, base_folder, collection_name, filename, id_fn=None, metadata_fn=None):
+async def _settle_import_batch(batch, filename):
+    # Returns (rows stored, rows failed) for the finished add; a failed chunk is logged so the
+    # chunks still in flight can be drained before the import reports the failure
+    task, rows = batch
+    try:
+        await task
+    except Exception as e:
+        print(f"Error adding batch from {filename}: {e}")
+        return 0, rows
+    return rows, 0
+
+async def import_csv_to_chroma(client, base_folder, collection_name, filename, id_fn=None, metadata_fn=None, batch_size=IMPORT_BATCH):
     filepath = os.path.join(base_folder, filename)
     if not os.path.exists(filepath):
         print(f"File not found: {filepath}")
         return
 
     try:
-        client.delete_collection(collection_name)
+        await client.delete_collection(collection_name)
     except Exception:
         pass
 
-    collection = client.get_or_create_collection(collection_name)
-    ids, docs, metas = [], [], []
+    collection = await client.get_or_create_collection(collection_name)
+    total = 0
+    failed = 0
+    pending = deque()
 
-    with open(filepath, "r", encoding="utf-8") as f:
+    with open(filepath, "r", encoding="utf-8", newline="", buffering=IMPORT_READ_BUFFER) as f:
         reader = csv.DictReader(f)
-        for row in reader:
-            try:
-                doc = row["document"].strip()
-                meta = json.loads(row["metadata"]) if row.get("metadata") else {}
-
-                if callable(metadata_fn):
-                    try:
-                        meta = metadata_fn(meta, row)
-                    except Exception as e:
-                        print(f"metadata_fn error on {filename}: {e}")
-
-                # Prefer explicit CSV id column if present
-                rid = None
-                if "id" in row and str(row["id"]).strip() != "":
-                    rid = str(row["id"]).strip()
-                elif callable(id_fn):
-                    try:
-                        rid = id_fn(meta, row)
-                    except Exception as e:
-                        print(f"id_fn error on {filename}: {e}")
-                        rid = None
-
-                if not rid:
-                    rid = str(uuid.uuid4())
-
-                ids.append(rid)
-                docs.append(doc)
-                metas.append(meta)
-            except Exception as e:
-                print(f"Error reading {filename}: {e}")
-
-    if docs:
-        collection.add(ids=ids, documents=docs, metadatas=metas)
-        print(f"Imported {len(docs)} documents into '{collection_name}'.")
+        # Read and send batch_size rows at a time, so large files are never held in memory whole;
+        # each add starts as soon as its chunk is parsed and at most IMPORT_CONCURRENCY stay in flight
+        while True:
+            rows = list(islice(reader, batch_size))
+            if not rows:
+                break
+
+            ids, docs, metas = [], [], []
+            # Fallback ids for the whole chunk come from one urandom call (128 random bits each, hex-encoded)
+            entropy = os.urandom(16 * len(rows))
+            for i, row in enumerate(rows):
+                try:
+                    doc = row["document"].strip()
+                    meta = orjson.loads(row["metadata"]) if row.get("metadata") else {}
+
+                    if callable(metadata_fn):
+                        try:
+                            meta = metadata_fn(meta, row)
+                        except Exception as e:
+                            print(f"metadata_fn error on {filename}: {e}")
+
+                    # Prefer explicit CSV id column if present
+                    rid = None
+                    if "id" in row and str(row["id"]).strip() != "":
+                        rid = str(row["id"]).strip()
+                    elif callable(id_fn):
+                        try:
+                            rid = id_fn(meta, row)
+                        except Exception as e:
+                            print(f"id_fn error on {filename}: {e}")
+                            rid = None
+
+                    if not rid:
+                        rid = entropy[16 * i:16 * i + 16].hex()
+
+                    ids.append(rid)
+                    docs.append(doc)
+                    metas.append(meta)
+                except Exception as e:
+                    print(f"Error reading {filename}: {e}")
+
+            if docs:
+                pending.append((asyncio.ensure_future(collection.add(ids=ids, documents=docs, metadatas=metas)), len(docs)))
+            if len(pending) >= IMPORT_CONCURRENCY:
+                stored, lost = await _settle_import_batch(pending.popleft(), filename)
+                total, failed = total + stored, failed + lost
+            else:
+                # Let the new add put its request on the wire before parsing the next chunk
+                await asyncio.sleep(0)
+
+    while pending:
+        stored, lost = await _settle_import_batch(pending.popleft(), filename)
+        total, failed = total + stored, failed + lost
+
+    if failed:
+        raise RuntimeError(f"{failed} documents from {filename} could not be added to '{collection_name}' ({total} imported).")
+    if total:
+        print(f"Imported {total} documents into '{collection_name}'.")
     else:
         print(f"No valid data in {filename}.")
+
+
+async def import_tables(tenant, host, port, jobs):
+    # jobs: (database, folder, collection_name) triples, imported concurrently over one AsyncHttpClient per database
+    clients = {}
+    for database in dict.fromkeys(database for database, _, _ in jobs):
+        clients[database] = await chromadb.AsyncHttpClient(host=host, port=port, tenant=tenant, database=database)
+
+    # Let every import finish, then fail the run if any of them did
+    results = await asyncio.gather(*[
+        import_csv_to_chroma(clients[database], folder, name, f"{name}.csv")
+        for database, folder, name in jobs
+    ], return_exceptions=True)
+    failures = [f"{database}/{name}: {result}" for (database, _, name), result in zip(jobs, results) if isinstance(result, Exception)]
+    if failures:
+        raise RuntimeError("Import failed for " + "; ".join(failures))